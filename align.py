@@ -0,0 +1,92 @@
+'''align.py
+
+Runs a multiple aligner (e.g. ginsi, which ships with mafft) on the output of
+the extraction as it is produced, rather than by hand once it is all done.
+An alignpool stands in for the fasta object given to
+classify.full_transposon_treatment(): each set of entries written to it (one
+island's worth) is saved to a temporary file and handed to its own aligner
+process, at most *jobs* of them at once, while the extraction goes on. The
+aligned output of each set is written to the real output in the order the
+sets were written, whatever order the aligners finish in.
+
+The aligner command is given as a string, e.g. 'ginsi --quiet'. The name of
+the input file is put in place of {} if the command has one, and added to
+the end otherwise; the aligner must write its alignment to stdout. Any
+command that does so will do -- e.g. 'cat', which leaves the output as if
+there were no aligner at all.
+'''
+
+import collections as _coll, os as _os, os.path as _path, shlex as _shlex
+import shutil as _shutil, subprocess as _proc, tempfile as _tempfile
+import fasta
+
+class Error(Exception):
+    """Special exception class thrown by functions in this module."""
+
+def aligncmd(cmd,fname):
+    '''Returns the argument list running the aligner command *cmd* (a
+    string) on the file *fname*.'''
+    args = _shlex.split(cmd)
+    if not args: raise Error('empty aligner command')
+    if '{}' not in args: return args + [fname]
+    return [fname if a == '{}' else a for a in args]
+
+class alignpool(object):
+    '''Aligns each set of entries written to it with the command *cmd*,
+    running at most *jobs* aligners at once, and writes the results, in
+    order, to *out* (a writeable fasta object). Closing the pool waits for
+    the aligners still running; *out* is left open.'''
+    def __init__(self,cmd,out,jobs=1):
+        if jobs < 1: raise Error('need at least one aligner job')
+        self._cmd,self._out,self._jobs = cmd,out,jobs
+        self._dir = _tempfile.mkdtemp(prefix='align.')
+        self._running,self._n = _coll.deque(),0
+    def writeentries(self,entries,parse=None):
+        '''Starts an aligner on *entries*, once one of the *jobs* is free.'''
+        while len(self._running) >= self._jobs: self._collect(wait=True)
+        self._n += 1
+        name = _path.join(self._dir,'{}.fa'.format(self._n))
+        with fasta.fasta(name,'w') as f: f.writeentries(entries,parse=parse)
+        result = open(name+'.aln','w+')
+        # not the extraction's stdin, which may be the hits being read
+        try:
+            with open(_os.devnull) as null:
+                p = _proc.Popen(aligncmd(self._cmd,name),stdin=null,
+                                stdout=result)
+        except OSError as e:
+            result.close()
+            raise Error('cannot run aligner {!r}: {}'.format(self._cmd,e))
+        self._running.append((p,name,result))
+        self._collect()
+    def _collect(self,wait=False):
+        '''Writes out the results of the aligners that have finished, as
+        far as the first still running (waiting for it if *wait* is true).'''
+        while self._running:
+            p,name,result = self._running[0]
+            if (p.wait() if wait else p.poll()) is None: return
+            self._running.popleft() ; wait = False
+            with result:
+                if p.returncode: raise Error(
+                    'aligner {!r} failed on set {} (exit status {})'.format(
+                        self._cmd,_path.basename(name)[:-3],p.returncode))
+                result.seek(0)
+                for chunk in iter(lambda: result.read(1<<16),''):
+                    self._out.writeentry(chunk,parse=fasta.RAW)
+            _os.remove(name) ; _os.remove(name+'.aln')
+    def close(self):
+        '''Waits for the remaining aligners and writes out their results.
+        If one has failed, the others are stopped.'''
+        try:
+            while self._running: self._collect(wait=True)
+        finally: self.abort()
+    def abort(self):
+        '''Stops the aligners still running, discarding their results.'''
+        for p,name,result in self._running:
+            if p.poll() is None: p.kill() ; p.wait()
+            result.close()
+        self._running.clear()
+        _shutil.rmtree(self._dir,ignore_errors=True)
+    def __enter__(self): return self
+    def __exit__(self,type,value,traceback):
+        if type is None: self.close()
+        else: self.abort()
@@ -5,8 +5,11 @@ A script that automates the pipeline between blastn and extract.py. In the
 future, this script may automate the role of mafft or some other multiple
 alignment program; for now, you must manually run the multiple aligner of your
 choice (we recommend ginsi, which ships with mafft) on the output of this
-program. This program requires a working installation of BLAST+; see the
-accompanying file BLASTHELP for more information on this.
+program, or name it with --align (e.g. --align=ginsi) to have each island
+aligned as soon as it is extracted. (With --dedup, only one copy of each
+distinct sequence need be aligned; 'expand' restores the rest.) This program
+requires a working installation of BLAST+; see the accompanying file
+BLASTHELP for more information on this.
 
 EDIT (Oct 2015):
 The "accompanying" file BLASTHELP has been lost, and in the intervening four
@@ -20,38 +23,60 @@ https://blast.ncbi.nlm.nih.gov/Blast.cgi?PAGE_TYPE=BlastDocs&DOC_TYPE=Download
 '''
 
 import glob, os, sys, os.path as path, subprocess as proc, argparse as arg
-import textwrap, itertools as it, signal
-import fasta, classify, extract, utils
+import textwrap, itertools as it, signal, collections as coll, tempfile
+import shutil, time, multiprocessing as mp, csv
+import fasta, classify, extract, utils, customcsv, service, planner
+import prefilter, dedup
 
 def main(args):
     return args.func(args,args.blargs) # args.func can be blast_func,
-                                       # extract_func, or ext_from_archive_func
+                                       # extract_func, ext_from_archive_func,
+                                       # batch_func, serve_func, submit_func
+                                       # or expand_func
 
 def functionmaker(f):
     def new_f(args,blargs):
-        tups = tuple(map(tuple,f(args,blargs)))
-        if args.dry_run:
-            print pipestr(tups,stdout=args.out,append=args.mode=='a')
-            return 0
-        with utils.quickopen(args.out,args.mode) as out:
-            process = pipe_together(tups,stdout=out,shell=False,bufsize=-1)
-            return process.wait()
+        subset = None
+        if getattr(args,'prefilter',False) or getattr(args,'prefilter_dir',0):
+            if not args.dry_run: subset = prefilter_subject(args)
+            else: print '# --prefilter: blastn searches only the scaffolds' \
+                ' of {} sharing k-mers with the query'.format(args.subject)
+        try: return _run(f,args,blargs)
+        finally:
+            if subset is not None: os.remove(subset)
     return new_f
 
+def _run(f,args,blargs):
+    plan = None
+    if hasattr(args,'auto') and (args.auto or args.dry_run):
+        plan = make_plan(args,[(args.query,args.db,args.subject)])
+    if plan is not None and args.auto:
+        if args.db is not None and '-num_threads' not in blargs:
+            blargs = ('-num_threads',str(plan.THREADS)) + tuple(blargs)
+        _apply_sort_mem(args,plan)
+    tups = tuple(map(tuple,f(args,blargs)))
+    if args.dry_run:
+        if plan is not None:
+            for line in planner.formatplan(plan): print '#', line
+        print pipestr(tups,stdout=args.out,append=args.mode=='a')
+        return 0
+    with utils.quickopen(args.out,args.mode) as out:
+        process = pipe_together(tups,stdout=out,shell=False,bufsize=-1)
+        return process.wait()
+
 @functionmaker
 def blast_func(args,blargs):
     if args.archive and args.mode=='a': 
         raise CmdLineError('Cannot append to an archive.')
-    yield blast_cmd_tup(query=args.query,subject=args.subject,db=args.db,
-                        archive=args.archive,*blargs)
+    yield blast_cmd_tup(args.query,args.db,args.subject,args.archive,*blargs)
     if not args.archive:  yield sed_cmd_tup()
 
 @functionmaker
 def extract_func(args,blargs):
     if '-' is args.query:
        raise CmdLineError('Cannot use stdin for query')
-    yield blast_cmd_tup(query=args.query,db=args.db,subject=args.subject,
-                        archive=False,*blargs)
+    _refuse_unpassed(args,'extract')
+    yield blast_cmd_tup(args.query,args.db,args.subject,False,*blargs)
     yield sed_cmd_tup()
     yield te_extraction_tup(args)
     yield ('cat',args.query,'-')
@@ -62,11 +87,226 @@ def ext_from_archive_func(args,blargs):
        raise CmdLineError('option {0[0]} not understood'.format(blargs))
     if args.query=='-':
        raise CmdLineError('Cannot use stdin for query')
+    _refuse_unpassed(args,'ar-extract')
     yield ('blast_formatter','-outfmt',_std_outfmt,'-archive',args.archive)
     yield sed_cmd_tup()
     yield te_extraction_tup(args)
     if args.query is not None: yield ('cat',args.query,'-')
 
+def batch_func(args,blargs):
+    '''Runs every job of the manifest *args.manifest* (see read_manifest()),
+    keeping at most *args.jobs* blast searches going at once and splitting
+    the *args.cpus* available processors between them with -num_threads.
+    A search whose hits are in is handed straight to extract.py, which runs
+    alongside the searches still in progress (and is counted as using one
+    processor). A per-job status table is written to *args.status*.'''
+    if '-num_threads' in blargs: raise CmdLineError(
+        '-num_threads is set by the batch command; use --cpus/--jobs instead')
+    _refuse_unpassed(args,'batch')
+    jobs = list(read_manifest(args.manifest))
+    if not jobs: return 0
+    cpus = args.cpus or mp.cpu_count()
+    plan = make_plan(args,[(job.QUERY,) + ((job.SUBJECT,None) if job.DB else
+                                           (None,job.SUBJECT)) for job in jobs],
+                     cpus) if args.auto or args.dry_run else None
+    if args.auto and plan is not None:
+        width,threads = plan.CONCURRENT,plan.THREADS
+        extractions = plan.EXTRACTIONS
+        _apply_sort_mem(args,plan)
+    else:
+        width = max(1,min(args.jobs or cpus,len(jobs),cpus))
+        threads,extractions = max(1,cpus//width),len(jobs)
+    blargs = ('-num_threads',str(threads)) + tuple(blargs)
+    if args.dry_run:
+        if plan is not None:
+            for line in planner.formatplan(plan): print '#', line
+        for job in jobs:
+            csvname = '{}.{}.csv'.format(path.basename(job.OUT),job.N)
+            print '# job {0.N}: {0.QUERY} vs {0.SUBJECT}'.format(job)
+            print pipestr(_batch_blast(job,blargs),stdout=csvname)
+            print pipestr(_batch_extract(args,job,csvname),stdout=job.OUT)
+        return 0
+    workdir = tempfile.mkdtemp(prefix='blastextract.')
+    try: _run_batch(args,jobs,blargs,workdir,cpus,width,threads,extractions)
+    finally:
+        shutil.rmtree(workdir,ignore_errors=True)
+        with utils.quickopen(args.status,'w') as out:
+            wr = csv.writer(out,dialect='excel-tab',lineterminator='\n')
+            wr.writerow(_status_flds)
+            wr.writerows([job[k] for k in _status_flds] for job in jobs)
+    return int(any(job.STATUS != 'ok' for job in jobs))
+
+_status_flds = ('N','QUERY','SUBJECT','OUT','STATUS','BLAST_RC','EXTRACT_RC',
+                'THREADS','SECONDS')
+def read_manifest(fname):
+    '''Reads a batch manifest: a headered CSV (or tab-delimited) file with
+    columns QUERY and OUT, and one of DB or SUBJECT, each row of which is
+    a job. Yields one nameholder per job, with SUBJECT holding the database
+    or subject file and DB telling which of the two it is.'''
+    for n,job in enumerate(customcsv.parseHeaderedCSV(fname,
+                                        txtflds=('QUERY','OUT')),1):
+        db,subj = (job[k] if k in job else '' for k in ('DB','SUBJECT'))
+        if bool(db) == bool(subj): raise CmdLineError(
+            'manifest {!r}, job {}: give exactly one of DB or SUBJECT'.format(
+                fname,n))
+        if not path.isfile(job.QUERY): raise FileNotFoundError(
+            '%r is not a valid file name' % job.QUERY)
+        job.open()
+        job['N'],job['DB'],job['SUBJECT'] = n,bool(db),db or subj
+        job['STATUS'],job['BLAST_RC'],job['EXTRACT_RC'] = 'pending','',''
+        job['THREADS'],job['SECONDS'] = '',''
+        yield job
+
+def _batch_blast(job,blargs):
+    db,subj = (job.SUBJECT,None) if job.DB else (None,job.SUBJECT)
+    return (tuple(blast_cmd_tup(job.QUERY,db,subj,False,*blargs)),
+            tuple(sed_cmd_tup()))
+
+def _batch_extract(args,job,csvname):
+    jobargs = arg.Namespace(**vars(args)) ; jobargs.out = '-'
+    if args.dedup: # a map of each job's own, MAP.N.tsv for MAP.tsv
+        root,ext = path.splitext(args.dedup)
+        jobargs.dedup = '{}.{}{}'.format(root,job.N,ext)
+    return (tuple(te_extraction_tup(jobargs,input=csvname)),
+            ('cat',job.QUERY,'-'))
+
+def _run_batch(args,jobs,blargs,workdir,cpus,width,threads,extractions):
+    '''The scheduling loop of batch_func(): polls the running pipelines,
+    starting an extraction as each search finishes (if fewer than
+    *extractions* are running; else it waits its turn) and a new search
+    whenever a slot and enough processors are free. A pipeline that cannot
+    be started fails its job only; if the loop itself fails, the pipelines
+    still running are killed, and their jobs and those not yet done are
+    marked 'aborted'.'''
+    def finished(running,stage):
+        for item in list(running):
+            job,procs,f,t0 = item
+            rcs = [p.poll() for p in procs]
+            if None in rcs: continue
+            running.remove(item) ; f.close()
+            job[stage] = max(rcs,key=abs)
+            job['SECONDS'] = int(time.time()-job.T0)
+            yield job
+    def start(running,job,tups,outname,mode,status,failed):
+        try:
+            out = open(outname,mode)
+            try: procs = pipe_all(tups,stdout=out)
+            except: out.close() ; raise
+        except EnvironmentError as e:
+            job['STATUS'] = '{}: {}'.format(failed,e)
+        else:
+            job['STATUS'] = status ; running.append((job,procs,out,job.T0))
+    pending,blasting,extracting = coll.deque(jobs),[],[]
+    searched = coll.deque() # searches waiting for an extraction slot
+    try:
+        while pending or blasting or searched or extracting:
+            for job in finished(blasting,'BLAST_RC'):
+                if job.BLAST_RC: job['STATUS'] = 'blast failed'
+                else: job['STATUS'] = 'searched' ; searched.append(job)
+            for job in finished(extracting,'EXTRACT_RC'):
+                job['STATUS'] = 'extract failed' if job.EXTRACT_RC else 'ok'
+                os.remove(job.CSV)
+            while searched and len(extracting) < extractions:
+                job = searched.popleft()
+                start(extracting,job,_batch_extract(args,job,job.CSV),
+                      job.OUT,args.mode,'extracting','extract failed')
+            used = threads*len(blasting) + len(extracting)
+            while pending and len(blasting) < width and \
+                  (used + threads <= cpus or not (blasting or extracting)):
+                job = pending.popleft()
+                job['CSV'] = path.join(workdir,'{}.csv'.format(job.N))
+                job['THREADS'],job['T0'] = threads,time.time()
+                start(blasting,job,_batch_blast(job,blargs),job.CSV,'w',
+                      'blasting','blast failed')
+                used += threads
+            time.sleep(.1)
+    finally:
+        for job,procs,f,t0 in blasting + extracting:
+            for p in procs:
+                if p.poll() is None: p.kill()
+            for p in procs: p.wait()
+            f.close()
+        for job in jobs:
+            if job.STATUS in ('pending','blasting','searched','extracting'):
+                job['STATUS'] = 'aborted'
+
+def make_plan(args,jobs,cpus=None):
+    '''Returns planner.makeplan() for the given jobs -- (query,db,subject)
+    triples, one of db and subject being None -- or None, with a warning,
+    if the size of some query or subject cannot be found.'''
+    sizes = []
+    for query,db,subject in jobs:
+        if query in (None,'-'): return _noplan('query is read from stdin')
+        q,s = planner.query_length(query),planner.subject_length(subject,db)
+        if s is None: return _noplan('cannot find database %r'%db)
+        sizes.append((q,s))
+    return planner.makeplan(sizes,cpus)
+
+def _noplan(why):
+    print >>sys.stderr, 'warning: no plan made: %s' % why
+
+def prefilter_subject(args):
+    '''Puts in place of args.subject a temporary file holding only the
+    scaffolds that prefilter.py selects for args.query, and returns its
+    name; or returns None, with a warning, if there is nothing to select
+    (or nothing is selected, when the whole subject is searched).'''
+    if args.subject is None: return _noprefilter('no --subject to filter')
+    if args.query in (None,'-'):
+        return _noprefilter('query is read from stdin')
+    try: subset = prefilter.prefilter(args.query,args.subject,
+                      args.prefilter_seeds,cachedir=args.prefilter_dir)
+    except prefilter.Error as e: return _noprefilter(e)
+    if subset is None:
+        return _noprefilter('no scaffold shares a seed with the query')
+    args.subject = subset
+    return subset
+
+def _noprefilter(why):
+    print >>sys.stderr, 'warning: searching the whole subject: %s' % why
+
+def _apply_sort_mem(args,plan):
+    if hasattr(args,'sort_mem') and args.sort_mem is None and plan.SORT_MEM:
+        args.sort_mem = planner.size(plan.SORT_MEM)
+
+def serve_func(args,blargs):
+    if args.dry_run:
+        print 'serving at', _address(args), 'with', args.workers, 'workers'
+        return 0
+    try: service.serve(_address(args),args.workers,args.cache)
+    except service.Error as e: raise LocalError('service: %s'%e)
+    except KeyboardInterrupt: pass
+    return 0
+
+def submit_func(args,blargs):
+    job = dict((k,getattr(args,k)) for k in extract.defaults
+               if getattr(args,k) is not None)
+    # any other option of extract.py given must be one the service takes
+    for k in _extract_opts[1:] + _unpassed_opts:
+        val = getattr(args,k)
+        if k in extract.defaults or val is None or val is False or \
+           val == _unset.get(k): continue
+        if k not in service.options: raise CmdLineError(
+            '--{} cannot be used with submit'.format(k.replace('_','-')))
+        job[k] = val
+    if args.file != '-': job['file'] = path.abspath(args.file)
+    with utils.quickopen(args.out,args.mode) as out:
+        try: service.submit(_address(args),job,out)
+        except service.Error as e: raise LocalError('service: %s'%e)
+        except EnvironmentError as e:
+            raise LocalError('cannot reach service at %s: %s'%(
+                _address(args),e))
+    return 0
+
+def expand_func(args,blargs):
+    with fasta.fasta(args.file) as src:
+        with utils.quickopen(args.out,args.mode) as out:
+            try: dedup.expand(src,args.map,fasta.fasta(out,'f'))
+            except dedup.Error as e: raise LocalError(str(e))
+    return 0
+
+def _address(args):
+    return args.socket if args.port is None else args.port
+
 # should subclass all error classes for here.
 class LocalError(Exception):
      errcode = 1
@@ -101,16 +341,33 @@ def sed_cmd_tup(input=None):
     yield 'sed' ; yield '1i\\\n{}\n'.format(','.join(classify.allflds))
     if input is not None: yield input
     
+# the options of extract.py that are passed on to it
+_extract_opts = ('out','min_distance','min_length','max_overlap',
+                 'evalue_threshold','sort_mem','packed','align','align_jobs',
+                 'dedup','write_queue','top_k','per_scaffold')
+# extract.py's defaults, of the options whose default is not None or False
+_unset = {'write_queue':0, 'parse_jobs':1, 'cache_size':'4G'}
 def te_extraction_tup(args,input=None):
     if extract.__file__.endswith('.pyc'): yield extract.__file__[:-1]
     else: yield extract.__file__
-    for x in ('out','min_distance','min_length','max_overlap',
-              'evalue_threshold'):
+    for x in _extract_opts:
         val = getattr(args,x)
-        if val is not None:
+        if val is True: yield '--{}'.format(x.replace('_','-'))
+        elif val not in (None,False):
            yield '--{}={}'.format(x.replace('_','-'),val)
     yield '-' if input is None else input
 
+# the options of extract.py that are not passed on to it
+_unpassed_opts = ('sweep','cache','cache_dir','cache_size','parse_jobs')
+def _refuse_unpassed(args,command):
+    '''Raises CmdLineError if any option of extract.py that *command* does
+    not pass on to it was given.'''
+    for k in _unpassed_opts:
+        val = getattr(args,k)
+        if val is None or val is False or val == _unset.get(k): continue
+        raise CmdLineError('--{} cannot be used with {}'.format(
+            k.replace('_','-'),command))
+
 def pipestr(tups,stdout=None,stdin=None,append=False):
     def stringify(s):
         if any(c in s for c in '\n$!\\` "\t'): 
@@ -134,17 +391,27 @@ def pipestr(tups,stdout=None,stdin=None,append=False):
     return cmdstr
 
 def pipe_together(argtuples,stdout=None,stdin=None,**kwds):
+    return pipe_all(argtuples,stdout=stdout,stdin=stdin,**kwds)[-1]
+
+def pipe_all(argtuples,stdout=None,stdin=None,**kwds):
+    '''Like pipe_together(), but returns every process of the pipeline.'''
     if not argtuples: raise TypeError('must have at least one tuple for pipe')
-    streams = [stdin]
-    for n,tup in enumerate(argtuples):
-        nosigpipe = tup[0].startswith('python') or tup[0].endswith('.py')
-        p = proc.Popen(tup,
-                       stdin=streams[-1],
-                       stdout=stdout if n+1==len(argtuples) else proc.PIPE,
-                       preexec_fn=None if nosigpipe else utils.restoresigpipe,
-                       **kwds)
-        streams.append(p.stdout)
-    return p
+    streams,procs = [stdin],[]
+    try:
+        for n,tup in enumerate(argtuples):
+            nosigpipe = tup[0].startswith('python') or tup[0].endswith('.py')
+            p = proc.Popen(tup,
+                         stdin=streams[-1],
+                         stdout=stdout if n+1==len(argtuples) else proc.PIPE,
+                         preexec_fn=None if nosigpipe else utils.restoresigpipe,
+                         **kwds)
+            if n: streams[-1].close() # the child has its own copy now
+            streams.append(p.stdout) ; procs.append(p)
+    except: # stop the part of the pipeline already started
+        if n: streams[-1].close()
+        for p in procs: p.kill() ; p.wait()
+        raise
+    return procs
 
 # action that checks whether the argument is a valid file
 class FileCheckAction(arg.Action):
@@ -165,7 +432,9 @@ def make_parser():
         parser.add_argument('--dry-run',action='store_true', help='''
                If specified, %(prog)s will print a shell-able version of the
                commands it executes, and then exit. May help users learn to
-               use the underlying tools directly.''')
+               use the underlying tools directly. Where the sizes of the
+               query and subject are known, it is preceded by a plan for
+               the run (see --auto), as comments.''')
  
     def doblastparser(parser):
         subj = parser.add_mutually_exclusive_group(required=True)
@@ -182,6 +451,22 @@ def make_parser():
         parser.add_argument('-q','--query',action=FileCheckAction,help='''\
           The query sequence(s) for the blast search; should be a single
           transposon sequence.''')
+        parser.add_argument('--auto',action='store_true',help='''
+          Size the run from the lengths of the query and subject and the
+          processors and memory of this machine, and set blastn's
+          -num_threads (with --db) and extract.py's --sort-mem accordingly,
+          unless they are given. --dry-run prints the plan either way.''')
+        parser.add_argument('--prefilter',action='store_true',help='''
+          With --subject, search only the scaffolds sharing k-mers with
+          the query, found from an index of the subject which is kept next
+          to it (as SUBJECT.pcache) for later runs. Hits keep the
+          coordinates of the original scaffolds. Meant for megablast (the
+          default task); shorter seeds may find hits elsewhere.''')
+        parser.add_argument('--prefilter-seeds',type=int,default=1,help='''
+          Number of sampled k-mers a scaffold must share with the query
+          to be searched with --prefilter (default %(default)s).''')
+        parser.add_argument('--prefilter-dir',help='''
+          Like --prefilter, but keeps the index in the given directory.''')
         parser.add_argument('blargs',nargs='*',help='''Any unrecognized
             arguments (i.e., those not mentioned elsewhere) are passed
             directly to blastn, allowing the use of options like -penalty or
@@ -237,7 +522,110 @@ def make_parser():
     doblastparser(extract_p) ; doeachparser(extract_p)
     extract.makeparser(extract_p)
     extract_p.set_defaults(func=extract_func)
-    
+
+    batch = subparsers.add_parser('batch',
+       fromfile_prefix_chars='@',
+       description='''This command runs many searches and extractions, as
+          '%(prog)s extract' would, from a manifest file: a CSV file with a
+          header and the columns QUERY, OUT, and DB or SUBJECT, one line per
+          job (use either column, and leave the other blank). Searches run
+          side by side within the --cpus budget, and each extraction starts
+          as soon as its search is done. Unknown options are passed to
+          blastn, as with '%(prog)s extract'. With --dedup MAP, each job
+          writes its own map, with its number (N in the status table)
+          before the extension of MAP: map.1.tsv, map.2.tsv, ... for
+          map.tsv.''')
+    batch.add_argument('-m','--manifest',action=FileCheckAction,
+       required=True,help='''The manifest file describing the jobs.''')
+    batch.add_argument('--cpus',type=int,help='''
+       Number of processors to use in all. Defaults to the number of
+       processors on this machine.''')
+    batch.add_argument('-j','--jobs',type=int,help='''
+       Maximum number of blast searches to run at once; the processors
+       are divided evenly between them (blastn -num_threads). Defaults
+       to one search per processor.''')
+    batch.add_argument('--auto',action='store_true',help='''
+       Size the run from the lengths of the queries and subjects and the
+       processors and memory available, choosing how many searches to run
+       at once, their -num_threads, how many extractions to run alongside
+       them and extract.py's --sort-mem (unless given) in place of --jobs.
+       --dry-run prints the plan either way.''')
+    batch.add_argument('--status',default='-',help='''
+       File to which to write the per-job status table (tab-delimited),
+       once all jobs are done. Defaults to standard output.''')
+    batch.add_argument('-a','--append',action='store_const',const='a',
+       dest='mode',default='w',help='''
+       If --append is specified, output is added to each job's output file,
+       as opposed to the default behavior of overwriting it.''')
+    batch.add_argument('--dry-run',action='store_true',help='''
+       If specified, %(prog)s will print a shell-able version of the
+       commands it would execute for each job, after the plan for the
+       run (see --auto) as comments, and then exit.''')
+    batch.add_argument('blargs',nargs='*',help='''Arguments passed
+       directly to blastn; put -- before them, as with %(prog)s extract.''')
+    extract.makeparser(batch)
+    batch.set_defaults(func=batch_func)
+
+    def doserviceparser(parser):
+        addr = parser.add_mutually_exclusive_group(required=True)
+        addr.add_argument('--socket',help='''
+           Path of the Unix socket at which the service listens.''')
+        addr.add_argument('--port',type=int,help='''
+           Port of localhost at which the service listens.''')
+        parser.set_defaults(blargs=())
+
+    serve = subparsers.add_parser('serve',
+       description='''Runs a resident extraction service, which does the
+          work of '%(prog)s ar-extract' or extract.py for jobs sent to it
+          by '%(prog)s submit' (or by any client; see service.py for the
+          protocol), in one long-running process.''')
+    doserviceparser(serve)
+    serve.add_argument('--workers',type=int,default=mp.cpu_count(),help='''
+       Number of jobs to run at once. Defaults to the number of processors
+       on this machine.''')
+    serve.add_argument('--cache',type=int,default=8,help='''
+       Number of parsed hit files to keep in memory for later jobs; 0
+       turns the cache off. Defaults to 8.''')
+    serve.add_argument('--dry-run',action='store_true',help='''
+       If specified, %(prog)s prints where it would listen, and exits.''')
+    serve.set_defaults(func=serve_func)
+
+    submit = subparsers.add_parser('submit',
+       description='''Sends an extraction job to a service started by
+          '%(prog)s serve', and writes the resulting fasta output.''')
+    doserviceparser(submit)
+    submit.add_argument('file',help='''
+       The CSV file of hits, as for extract.py. Use - to send the hits
+       from stdin; otherwise the service reads the file itself.''')
+    submit.add_argument('-o','--out',default='-',help='''
+       File to which to write output; defaults to standard output.''')
+    submit.add_argument('-a','--append',action='store_const',const='a',
+       dest='mode',default='w',help='''
+       If --append is specified, output is added to the output file, as
+       opposed to the default behavior of overwriting it.''')
+    extract.makeparser(submit)
+    submit.set_defaults(func=submit_func)
+
+    expand = subparsers.add_parser('expand',
+       description='''Undoes the --dedup option of extract.py (and of
+          '%(prog)s extract'): writes each entry of the extraction again,
+          with the sequence of the entry it was collapsed into, as found
+          in the given fasta file -- usually the alignment of the
+          deduplicated output, so that every copy gets its aligned
+          sequence.''')
+    expand.add_argument('file',action=FileCheckAction,help='''
+       The deduplicated entries, or their alignment. Use - to read them
+       from stdin.''')
+    expand.add_argument('-m','--map',action=FileCheckAction,required=True,
+       help='''The map written by --dedup.''')
+    expand.add_argument('-o','--out',default='-',help='''
+       File to which to write output; defaults to standard output.''')
+    expand.add_argument('-a','--append',action='store_const',const='a',
+       dest='mode',default='w',help='''
+       If --append is specified, output is added to the output file, as
+       opposed to the default behavior of overwriting it.''')
+    expand.set_defaults(func=expand_func,blargs=())
+
     return parser
 
 if __name__ == '__main__':
@@ -39,7 +39,8 @@ be modified in the latter form.
 
 import os as _os, itertools as _it, os.path as _path, argparse as _arg
 import functools as _func, contextlib as _cont, re as _re, customcsv as _csv
-import fasta, utils
+import fasta, utils, csvcache, packedseq as _packed
+from nameholder import nameholder
 from operator import attrgetter as _attrget, itemgetter as _itemget
 try: from cStringIO import StringIO as _sIO
 except ImportError: from StringIO import StringIO as _sIO
@@ -48,7 +49,8 @@ except ImportError: from StringIO import StringIO as _sIO
 # which prominence it is given first. It refers to several functions (e.g.
 # stratify(), classifyrecords()) that are defined later.
 def full_transposon_treatment(seq,overlap,gap,minlength,fastaout,evalue=None,
-                              fname=None):
+                              fname=None,presorted=False,topk=None,
+                              perscaffold=False):
     '''This is where it all comes together. This takes a sequence of
     hits, assumed to constitute an entire a blast search between one
     transposon and one fly genome. (See note below.)  It performs the
@@ -62,24 +64,42 @@ def full_transposon_treatment(seq,overlap,gap,minlength,fastaout,evalue=None,
     hitsfromcsv(). This can be done implicitly by giving None as the
     first argument, in which case *f* is expected to be a file object
     or filename to be given to hitstocsv().
+
+    The hits are taken by subject sequence (SSEQID), in order of SSEQID;
+    hits of several queries on one subject sequence make islands together.
+    If *presorted* is true, *seq* must come grouped and ordered that way
+    (as from sortedhits()), and only one group is held in memory at a time.
+
+    If *topk* is given, only the *topk* best islands (see bestislands()) of
+    the whole search -- or of each subject sequence, if *perscaffold* is
+    true -- are classified and written, in their usual order and with their
+    usual names; the others are dropped as soon as they cannot make the cut.
     '''
     if None not in (seq,fname):
           raise Error("Cannot give both seq and fname arguments")
     elif seq is None: seq = hitsfromcsv(fname)
-    for s,hits in utils.groupby(seq,key=_attrget('SSEQID')).iteritems():
-       for island in makeislands(hits,gap):
-          singles,nests = classifyrecords(island,overlap)
-          nests = [stratify(N,minlength) for N in nests]
-          if singles or any(nests):
-            fastaout.writeentries(resolve_query_overlap(singles,nests,overlap))
-          else: raise Error('No records result from file {!r}'.format(fname))
+    if presorted: groups = (list(g) for k,g in
+                            _it.groupby(seq,key=_attrget('SSEQID')))
+    else: groups = _bysubject(seq)
+    islands = (island for hits in groups for island in
+               (bestislands(makeislands(hits,gap),topk) if topk and perscaffold
+                else makeislands(hits,gap)))
+    if topk and not perscaffold: islands = bestislands(islands,topk)
+    for island in islands:
+        singles,nests = classifyrecords(island,overlap)
+        nests = [stratify(N,minlength) for N in nests]
+        if singles or any(nests):
+          fastaout.writeentries(resolve_query_overlap(singles,nests,overlap))
+        else: raise Error('No records result from file {!r}'.format(fname))
 
 _intflds = ('QSTART','QEND','SSTART','SEND')
 _txtflds = ('QSEQID','SSEQID','SSEQ')
 _fltflds = ('EVALUE',)
 allflds = tuple(_it.chain(_txtflds,_intflds,_fltflds))
 _intflds,_txtflds,_fltflds = map(frozenset,(_intflds,_txtflds,_fltflds))
-def hitsfromcsv(f_obj,intflds=(),fltflds=(),txtflds=(),evalue=None,**kwds):
+def hitsfromcsv(f_obj,intflds=(),fltflds=(),txtflds=(),evalue=None,
+                lazyseq=False,fields=None,packed=False,cache=None,
+                cachesize=None,jobs=1,**kwds):
     """Uses parseHeaderedCSV (see the module customcsv.py) to read a CSV
     file containing blast hits. The {int,flt,txt}flds options all behave
     as in that function, except they are augmented with the fields listed
@@ -89,28 +109,235 @@ def hitsfromcsv(f_obj,intflds=(),fltflds=(),txtflds=(),evalue=None,**kwds):
     
     There is support for evalue-based filtering; if the *evalue* argument
     is present, this function will yield only hits whose evalue is less.
+    The EVALUE field is checked before the rest of the line is converted.
+
+    If *lazyseq* is true, and *f_obj* is a file name, the SSEQ of each hit
+    is left in the file until it is needed (see customcsv.lazyfield). If
+    *fields* is given, fields of the file not named there or in *allflds*
+    are left out of the hits. If *packed* is true, SSEQ is read into a
+    packedseq.packedseq, which takes about a quarter of the memory.
+
+    If *cache* is given, and *f_obj* is a file name, the hits are kept in
+    a cache (see the module csvcache) for later calls on the same file:
+    next to it if *cache* is '', and in the directory *cache* otherwise,
+    where the least recently used caches are removed beyond *cachesize*
+    bytes. Hits read back from a cache skip parsing altogether. If a
+    conversion gives values that marshal cannot store as they are (e.g.
+    fasta.locus objects, or subclasses of str), no cache is written.
+
+    If *jobs* is more than 1, and *f_obj* is a file name, the file is
+    parsed by that many processes (see customcsv.parseHeaderedCSV()).
     
     setlength() is applied to each hit; each hit also receives an
     orientation, according to whether its SSTART/SEND numbers are in order
     or reversed, and _SSTART/_SEND values representing the subject ordinates
     in order. See top-level module documentation.
     """
-    for h in _csv.parseHeaderedCSV(f_obj,intflds=_intflds|set(intflds),
-                                   fltflds=_fltflds|set(fltflds),
-                                   txtflds=_txtflds|set(txtflds),**kwds):
-      if evalue is not None and h.EVALUE >= evalue: continue
-      h['ORIENTED'],h['_SSTART'],h['_SEND'] = \
-        (True,h.SSTART,h.SEND) if h.SSTART<=h.SEND else (False,h.SEND,h.SSTART)
-      setlength(h); yield h
+    if packed: kwds.setdefault('SSEQ',_packed.packedseq)
+    flds = (intflds,fltflds,txtflds,lazyseq,fields,kwds,jobs)
+    if cache is None or not isinstance(f_obj,basestring) or f_obj == '-':
+        return _hitsfromcsv(f_obj,evalue,*flds)
+    return _cachedhits(f_obj,cache,cachesize,evalue,*flds)
+
+def _hitsfromcsv(f_obj,evalue,intflds,fltflds,txtflds,lazyseq,fields,kwds,
+                 jobs):
+    # (with *jobs*, the parsing processes make the hits whole, _orient and all)
+    return _csv.parseHeaderedCSV(f_obj,intflds=_intflds|set(intflds),
+                                 fltflds=_fltflds|set(fltflds),
+                                 txtflds=_txtflds|set(txtflds),
+          where=None if evalue is None else {'EVALUE': lambda e: e < evalue},
+          lazyflds=('SSEQ',) if lazyseq else (),project=fields,jobs=jobs,
+          derive=_orient,**kwds)
+def _orient(h):
+    h['ORIENTED'],h['_SSTART'],h['_SEND'] = \
+      (True,h.SSTART,h.SEND) if h.SSTART<=h.SEND else (False,h.SEND,h.SSTART)
+    setlength(h)
+
+# A cached hit is (keys,hidden keys,values), with SSEQ as its text or, if it
+# was left in the file, as the (offset,length) of its lazyfield. The cache is
+# of all the hits (the evalue threshold is applied when they are read back)
+# and its SSEQ is unconverted, so neither *evalue* nor *packed* need a new one.
+def _cachedhits(fname,cache,cachesize,evalue,*flds):
+    intflds,fltflds,txtflds,lazyseq,fields,kwds,jobs = flds
+    convs = dict((k,str) for k in _txtflds|set(map(str.upper,txtflds)))
+    convs.update((k,int) for k in _intflds|set(map(str.upper,intflds)))
+    convs.update((k,float) for k in _fltflds|set(map(str.upper,fltflds)))
+    convs.update((k.upper(),v) for k,v in kwds.items())
+    sseq = convs.pop('SSEQ') if lazyseq else convs.get('SSEQ',str)
+    # how the hits were parsed, which a cache must match
+    signature = (sorted((k,getattr(v,'__name__',repr(v)))
+                        for k,v in convs.iteritems() if k != 'SSEQ'),
+                 bool(lazyseq),
+                 None if fields is None else sorted(map(str.upper,fields)))
+    rows = csvcache.load(fname,signature,cache)
+    if rows is None:
+        hits = _cachinghits(fname,cache,cachesize,evalue,signature,*flds)
+    else: hits = _cachedrows(fname,rows,evalue,lazyseq,sseq,convs)
+    for h in hits: yield h
+
+def _cachinghits(fname,cache,cachesize,evalue,signature,*flds):
+    try: writer = csvcache.writer(fname,signature,cache,cachesize)
+    except EnvironmentError: writer = None # then there is no cache
+    shapes,exact = {},csvcache.exact_types
+    try:
+        for h in _hitsfromcsv(fname,None,*flds):
+            if writer:
+                keys = tuple(h.iterkeys())
+                shown = set(h.fields())
+                hidden = tuple(k for k in keys if k not in shown)
+                if (keys,hidden) not in shapes: shapes[keys,hidden] = (
+                    tuple(map(intern,keys)),tuple(map(intern,hidden)))
+                keys,hidden = shapes[keys,hidden]
+                values = h.values()
+                i = keys.index('SSEQ') ; v = values[i]
+                values[i] = v.span() if isinstance(v,_csv.lazyfield) else str(v)
+                # a value marshal would not give back as it was (such as a
+                # subclass of str, made by a conversion) spoils the cache
+                try:
+                    if not set(map(type,values)) <= exact: raise ValueError
+                    writer.add((keys,hidden,tuple(values)))
+                except ValueError: writer.discard() ; writer = None
+            if evalue is None or h.EVALUE < evalue: yield h
+        if writer: writer.commit()
+    finally:
+        if writer: writer.discard()
+
+def _cachedrows(fname,rows,evalue,lazyseq,sseq,convs):
+    source = _csv.source(fname) if lazyseq else None
+    shapes,fromstate,lazyfield = {},nameholder.fromstate,_csv.lazyfield
+    for keys,hidden,values in rows:
+        if keys not in shapes:
+            shapes[keys] = keys.index('SSEQ'),keys.index('EVALUE')
+        i,e = shapes[keys]
+        if evalue is not None and not values[e] < evalue: continue
+        values = list(values)
+        values[i] = lazyfield(source,values[i][0],values[i][1],sseq) \
+                    if lazyseq else sseq(values[i])
+        yield fromstate(zip(keys,values),hidden,False,convs)
+
+def _bysubject(seq):
+    '''Returns the hits of *seq* in lists by SSEQID, in order of SSEQID.'''
+    return [g for k,g in sorted(utils.groupby(seq,
+                                              key=_attrget('SSEQID')).items())]
+
+def sortedhits(seq,maxmem=None,tmpdir=None):
+    '''Returns an iterator over the hits of *seq*, sorted by SSEQID and
+    otherwise in their original order, as full_transposon_treatment()
+    expects with presorted=True. Uses at most about *maxmem* bytes of
+    memory, sorting on disk (in *tmpdir*) if need be: see
+    utils.external_sort().'''
+    return utils.external_sort(seq,key=_attrget('SSEQID'),
+                               maxmem=maxmem,sizeof=_hitsize,tmpdir=tmpdir)
+# A rough estimate of the memory taken by a hit (a lazyfield is small).
+def _hitsize(h):
+    if isinstance(h.SSEQ,basestring): return 2048 + len(h.SSEQ)
+    if isinstance(h.SSEQ,_packed.packedseq): return 2048 + len(h.SSEQ)//4
+    return 2048
 
 def makeislands(seq,gaplength):
-    L = list(utils.components(seq,rel=lambda x,y: s_distance(x,y)<=gaplength))
+    L = list(utils.components(seq,**_distance_rel(s_distance,gaplength)))
     L.sort(key=lambda L: L[0].SSTART)
     for i,island in enumerate(L,1):
         suff = '_{}'.format(i)
         for hit in island: hit['SSEQID'] += suff
     return L
 
+def island_rank(island):
+    '''The rank of an island: that of its best hit (see hit_rank()).'''
+    return max(map(hit_rank,island))
+
+def bestislands(islands,k):
+    '''Returns the *k* best of the given islands, by island_rank(), in the
+    order given; of islands ranked the same, the first win. Besides the one
+    being ranked, at most *k* islands are held at a time.'''
+    heap = utils.indexheap() # the worst candidate on top
+    for n,island in enumerate(islands):
+        rank = island_rank(island),-n
+        if len(heap) < k: heap.push((n,island),rank)
+        elif rank > heap.peek()[1]: heap.pop() ; heap.push((n,island),rank)
+    return [island for n,island in sorted(heap.pop()[0]
+                                          for i in xrange(len(heap)))]
+
+def sweep(seq,gaps,overlaps,minlengths,evalues,fastaout):
+    '''Does the work of full_transposon_treatment() for every combination
+    of the given lists of gaps, overlaps, minlengths and evalues (an evalue
+    of None meaning no threshold), reading the hits of *seq* only once.
+    fastaout(gap,overlap,minlength,evalue) must return the writeable fasta
+    object for that combination. Returns a dict, keyed the same way, of
+    dicts counting the ISLANDS, NESTS and ENTRIES written for each.
+
+    A larger gap can only merge islands, so the islands for all gaps are
+    built together (see _sweepislands()), and an island whose hits are the
+    same as under a smaller gap or another evalue is not classified or
+    stratified again.
+    '''
+    hits = list(seq)
+    counts = dict((k,dict(ISLANDS=0,NESTS=0,ENTRIES=0)) for k in
+                  _it.product(gaps,overlaps,minlengths,evalues))
+    for group in _bysubject(hits):
+        done = {} # classified islands, by their hits and settings
+        for e in evalues:
+            ehits = group if e is None else [h for h in group if h.EVALUE < e]
+            if not ehits: continue
+            for gap,islands in _sweepislands(ehits,sorted(set(gaps))):
+                for overlap,minlength in _it.product(overlaps,minlengths):
+                    key = gap,overlap,minlength,e
+                    out,count = fastaout(*key),counts[key]
+                    for i,island in enumerate(islands,1):
+                        k = (tuple(map(id,island)),overlap,minlength)
+                        if k not in done:
+                            singles,nests = classifyrecords(island,overlap)
+                            done[k] = (singles,
+                                       [list(stratify(N,minlength))
+                                        for N in nests])
+                        singles,nests = done[k]
+                        if not (singles or any(nests)): raise Error(
+                            'No records result from island {!r}'.format(
+                                island[0].SSEQID))
+                        # naming and numbering happen on copies, so that
+                        # the hits can be reused under other settings
+                        suff = '_{}'.format(i)
+                        singles,nests = _suffixed(singles,suff),\
+                                        [_suffixed(N,suff) for N in nests]
+                        entries = list(resolve_query_overlap(singles,nests,
+                                                             overlap))
+                        out.writeentries(entries)
+                        count['ISLANDS'] += 1
+                        count['NESTS'] += len(nests)
+                        count['ENTRIES'] += len(entries)
+    return counts
+
+def _suffixed(hits,suff):
+    hits = [h.copy() for h in hits]
+    for h in hits: h['SSEQID'] += suff
+    return hits
+
+def _sweepislands(hits,gaps):
+    '''Yields (gap,islands) for each of the given *gaps* (in increasing
+    order), the islands being those makeislands(hits,gap) would return,
+    without renaming the hits. Two neighbours, taken in order of start,
+    join once the gap reaches the distance from the later one's start to
+    the farthest end before it; so each gap only merges, in a
+    utils.disjoint_set, the neighbours the last one did not.'''
+    st,end = _ordinates[s_distance]
+    order = sorted(xrange(len(hits)),key=lambda i: st(hits[i]))
+    joins,reach = [],None
+    for k,i in enumerate(order):
+        if k: joins.append((st(hits[i])-reach,k))
+        reach = end(hits[i]) if reach is None else max(reach,end(hits[i]))
+    joins.sort(reverse=True)
+    classes = utils.disjoint_set(xrange(len(hits)))
+    for gap in gaps:
+        if gap >= 0: # (with a negative gap, every hit is its own island)
+            while joins and joins[-1][0] <= gap:
+                k = joins.pop()[1] ; classes.union(order[k-1],order[k])
+        # put each island in the order makeislands() would
+        L = [next(utils.components([hits[i] for i in C],
+                                   **_distance_rel(s_distance,gap)))
+             for C in classes.classes()]
+        L.sort(key=lambda L: L[0].SSTART)
+        yield gap,L
+
 def classifyrecords(seq,overlap):
     '''Takes a sequence of blast hits; picks out as 'nests' sequences of
     adjacent hits that overlap with a neighbor. Returns a pair of lists:
@@ -122,7 +349,7 @@ def classifyrecords(seq,overlap):
     algorithm, they must go through the function stratify().
     '''
     sings,nests = utils.bifilter(
-                     utils.components(seq,lambda x,y: s_overlap(x,y)>=overlap),
+                     utils.components(seq,**_overlap_rel(s_overlap,overlap)),
                      key=lambda x: len(x)==1)
     return (map(_itemget(0),sings),nests)
 
@@ -177,7 +404,7 @@ def resolve_query_overlap(standalones,nests,overlap):
             seq.write('-'*(hit.QSTART-1-( prev and prev.QEND or 0 )))
             if prev is None: st,end = hit._SSTART,hit._SEND
             else: st,end = min(st,hit._SSTART),max(end,hit._SEND);
-            seq.write(hit.SSEQ)
+            seq.write(str(_csv.resolve(hit.SSEQ)))
             prev = hit
         result = fasta.seq_entry({'SEQ': seq.getvalue(),
          'NAME': _name_fmt.format(_GRP='all',SSEQID=recs[0].SSEQID,
@@ -214,6 +441,23 @@ def s_overlap(x,y):
     and y overlap. Returns zero if and only if they are disjoint.'''
     return _overlap(x,y,_attrget('_SSTART'),_attrget('_SEND'))
 
+# The ordinates measured by each distance/overlap function, so that relations
+# built from them can be handed to utils.components() as intervals. (Note that
+# s_distance, as last defined above, measures query ordinates.)
+_ordinates = {
+  s_distance: (_attrget('QSTART'),_attrget('QEND')),
+  q_overlap: (_attrget('QSTART'),_attrget('QEND')),
+  s_overlap: (_attrget('_SSTART'),_attrget('_SEND')),
+}
+def _distance_rel(dist,gap):
+    '''Keywords for utils.components() for the relation dist(x,y)<=gap.'''
+    if gap < 0: return dict(rel=lambda x,y: dist(x,y)<=gap)
+    return dict(interval=_ordinates[dist]+(gap,))
+def _overlap_rel(ovl,overlap):
+    '''Keywords for utils.components() for the relation ovl(x,y)>=overlap.'''
+    if overlap < 1: return dict(rel=lambda x,y: ovl(x,y)>=overlap)
+    return dict(interval=_ordinates[ovl]+(1-overlap,))
+
 fmtstr = 'Can remove at most %d chars from given string (%d given)'
 def extend(s,n):
     '''Stub function, included for debugging purposes: raises an error
@@ -227,6 +471,9 @@ def shortenhead(s,n):
     '''This function shortens the given sequence string by *n* base pairs
     (not including gaps) at the beginning. Used by set__SSTART(), set__SEND().
     '''
+    if isinstance(s,_packed.packedseq):
+        if n > s.nbases(): raise Error(fmtstr % (s.nbases(),n))
+        return s.lstrip_bases(n)
     start = 0
     while start < len(s) and s[start] == '-': start += 1
     for i in xrange(n):
@@ -238,6 +485,9 @@ def shortentail(s,n):
     '''This function shortens the given sequence string by *n* base pairs
     (not including gaps) at the end. Used by set__SSTART(), set__SEND().
     '''
+    if isinstance(s,_packed.packedseq):
+        if n > s.nbases(): raise Error(fmtstr % (s.nbases(),n))
+        return s.rstrip_bases(n)
     end = len(s)-1
     while end >= 0 and s[end] == '-': end -= 1
     for i in xrange(n):
@@ -254,7 +504,8 @@ def set__SSTART(hit,value):
     hit,change,nori = hit.copy(),value - hit._SSTART,not hit.ORIENTED
     p = 'START' if hit.ORIENTED else 'END'
     hit['Q'+p] += change*(-1)**nori ; hit['_SSTART'] = hit['S'+p] = value
-    hit['SSEQ'] = _actions[2*nori + (change<0)](hit.SSEQ,abs(change))
+    hit['SSEQ'] = _actions[2*nori + (change<0)](_csv.resolve(hit.SSEQ),
+                                                abs(change))
     setlength(hit) ; return hit
 def set__SEND(hit,value):
     '''Sets _SEND to the given value, and adjusts other attributes (query and
@@ -264,7 +515,8 @@ def set__SEND(hit,value):
     hit,change = hit.copy(),value - hit._SEND
     p = 'END' if hit.ORIENTED else 'START'
     hit['Q'+p] -= change*(-1)**hit.ORIENTED ; hit['S'+p] = hit['_SEND'] = value
-    hit['SSEQ'] = _actions[2*hit.ORIENTED + (change>0)](hit.SSEQ,abs(change))
+    hit['SSEQ'] = _actions[2*hit.ORIENTED + (change>0)](
+                      _csv.resolve(hit.SSEQ),abs(change))
     setlength(hit) ; return hit
 
 def _stratify(nest,rank,filterfunc,sget,sset,eget,eset):
@@ -285,13 +537,15 @@ def _stratify(nest,rank,filterfunc,sget,sset,eget,eset):
         [[s,s_],[e,e_]] = [[f(x) for x in (main,other)] for f in (sget,eget)]
         if s_ < s-1: yield eset(other,min(e_,s-1))
         if e+1 < e_: yield sset(other,max(e+1,s_))
-    nest = [(x,rank(x)) for x in nest if filterfunc(x)]
+    nest = utils.indexheap(((x,rank(x)) for x in nest if filterfunc(x)),
+                           reverse=True)
     while nest:
-       (h,r),i = utils.popmax(nest,key=_itemget(1)),0 ; yield h
-       while i < len(nest):
-          results = [(x,rank(x)) for x in s_hit(h,nest[i][0]) if filterfunc(x)]
-          nest[i:i+1] = results
-          i += len(results)
+       h,r = nest.pop() ; yield h
+       for i in nest.handles():
+          x = nest[i]
+          results = [y for y in s_hit(h,x) if filterfunc(y)]
+          if len(results)==1 and results[0] is x: continue # x is untouched
+          nest.splice(i,[(y,rank(y)) for y in results])
 
 def hit_rank(hit): return -hit.EVALUE,hit.LENGTH
 
@@ -312,5 +566,6 @@ def make_entry(hit,padded=True):
     query location unless *padded* is set to False.
     '''
     hit = hit.copy() ; hit.open()
-    hit.setdefault('SEQ',_fillchar*(hit.QSTART-1)*padded + hit.pop('SSEQ'))
+    hit.setdefault('SEQ',_fillchar*(hit.QSTART-1)*padded +
+                         str(_csv.resolve(hit.pop('SSEQ'))))
     return fasta.seq_entry(hit)
@@ -0,0 +1,133 @@
+'''csvcache.py
+
+Caches of what was parsed from CSV files, so that reading the same file
+again (e.g. the hits of one blast search, extracted with several settings)
+skips parsing its text. classify.hitsfromcsv() uses these when given a
+*cache* argument; see there.
+
+A cache holds rows -- tuples of marshallable values, one per record of the
+file -- written with marshal in chunks, so that it can be read back a chunk
+at a time. It lives next to the file (as FILE.pcache) or in a cache
+directory, under a name made from the file's path. It is used only if the
+file has the size and modification time it had when the cache was written,
+and the same content at the beginning and the end (by md5 of the first and
+last blocks, the first holding the header); and only if the rows were
+parsed the same way (see *signature* below). Otherwise it is written again.
+
+Caches are private to the user who writes them: they are created with mode
+0600 (by tempfile.mkstemp), whatever the umask, even next to a file that
+others can read.
+
+A cache directory is kept to a total size: each time a cache is written
+there, the least recently used caches are removed until the rest fit.
+'''
+
+import hashlib as _hashlib, marshal as _marshal, os as _os, os.path as _path
+import tempfile as _tempfile, glob as _glob
+
+_VERSION = 1
+_BLOCK = 1<<16
+_CHUNK = 10000 # rows per marshalled chunk
+_SUFFIX = '.pcache'
+# the types of value that marshal gives back as they were (not, e.g., a
+# subclass of str, which comes back as a str)
+exact_types = frozenset((int,long,float,complex,str,unicode,bool,tuple,
+                         type(None)))
+
+def fingerprint(fname):
+    '''Returns (size,mtime,md5 of the first and last blocks) of the file.'''
+    st = _os.stat(fname)
+    md5 = _hashlib.md5()
+    with open(fname,'rb') as f:
+        md5.update(f.read(_BLOCK))
+        if st.st_size > _BLOCK:
+            f.seek(max(_BLOCK,st.st_size-_BLOCK)) ; md5.update(f.read())
+    return (st.st_size,st.st_mtime,md5.hexdigest())
+
+def cachepath(fname,cachedir=None):
+    '''Returns the name of the cache of *fname*: next to it, or in
+    *cachedir* if that is given.'''
+    if not cachedir: return fname + _SUFFIX
+    key = _hashlib.md5(_path.realpath(fname)).hexdigest()
+    return _path.join(cachedir,key + _SUFFIX)
+
+def load(fname,signature,cachedir=None):
+    '''Returns an iterator over the cached rows of *fname*, or None if there
+    is no valid cache of it -- none at all, or one of a different version
+    of the file, or whose *signature* (which describes how the rows were
+    parsed, and must be marshallable) is different.'''
+    name = cachepath(fname,cachedir)
+    try:
+        f = open(name,'rb')
+        try: head = _marshal.load(f)
+        except (EOFError,ValueError,TypeError): head = None
+        if head != (_VERSION,fingerprint(fname),signature):
+            f.close() ; return None
+    except EnvironmentError: return None
+    try: _os.utime(name,None) # used, for eviction
+    except OSError: pass
+    return _rows(f)
+
+def _rows(f):
+    with f:
+        while True:
+            try: chunk = _marshal.load(f)
+            except EOFError: return
+            for row in chunk: yield row
+
+class writer(object):
+    '''Writes the cache of *fname*, a row at a time (see add()). Nothing
+    replaces an existing cache until commit(), which also keeps a cache
+    directory within *maxsize* bytes; discard() drops what was written.'''
+    def __init__(self,fname,signature,cachedir=None,maxsize=None):
+        self._fname,self._cachedir,self._maxsize = fname,cachedir,maxsize
+        self._name = cachepath(fname,cachedir)
+        if cachedir and not _path.isdir(cachedir): _os.makedirs(cachedir)
+        self._fp = fingerprint(fname)
+        # (marshal writes only to real files)
+        fd,self._tmp = _tempfile.mkstemp(dir=_path.dirname(self._name) or '.',
+                         prefix='.'+_path.basename(self._name),suffix='.tmp')
+        self._f,self._chunk = _os.fdopen(fd,'wb'),[]
+        try: _marshal.dump((_VERSION,self._fp,signature),self._f)
+        except: self.discard() ; raise
+    def add(self,row):
+        '''Adds a row: a tuple of marshallable values.'''
+        self._chunk.append(row)
+        if len(self._chunk) >= _CHUNK: self._flush()
+    def _flush(self):
+        _marshal.dump(self._chunk,self._f) ; self._chunk = []
+    def commit(self):
+        '''Puts the cache in place, unless the file changed meanwhile, or
+        the last rows cannot be marshalled (then it is discarded).'''
+        if self._f is None: return
+        try:
+            if self._chunk: self._flush()
+            self._f.close()
+            if fingerprint(self._fname) != self._fp: return self.discard()
+            _os.rename(self._tmp,self._name)
+        except (EnvironmentError,ValueError): return self.discard()
+        self._f = None
+        if self._cachedir and self._maxsize is not None:
+            evict(self._cachedir,self._maxsize,keep=self._name)
+    def discard(self):
+        '''Drops the cache being written.'''
+        if self._f is None: return
+        self._f.close()
+        try: _os.remove(self._tmp)
+        except OSError: pass
+        self._f = None
+
+def evict(cachedir,maxsize,keep=None):
+    '''Removes the least recently used caches in *cachedir* until the rest
+    take at most *maxsize* bytes, sparing the cache named *keep*.'''
+    caches = []
+    for name in _glob.glob(_path.join(cachedir,'*'+_SUFFIX)):
+        try: st = _os.stat(name)
+        except OSError: continue
+        caches.append((st.st_mtime,st.st_size,name))
+    total = sum(size for t,size,name in caches)
+    for t,size,name in sorted(caches):
+        if total <= maxsize: break
+        if name == keep: continue
+        try: _os.remove(name) ; total -= size
+        except OSError: pass
@@ -1,5 +1,8 @@
 #! /usr/bin/env python2.7
 import csv as _csv, os.path as _path, sys as _sys, os as _os, utils
+import threading as _threading, tempfile as _tempfile, itertools as _it
+import mmap as _mmap, multiprocessing as _mp, collections as _coll
+import contextlib as _contextlib, weakref as _weakref
 from nameholder import nameholder
 [PROMPT,FORCE,DONT_OVER,DONT_ALL] = range(4)
 [GETALL,IGNORE,DELETE] = range(3)
@@ -9,9 +12,12 @@ class Error(Exception):
     def __init__(self,*args): Exception.__init__(self,*args)
     def __hash__(self): return hash(tuple(self.items()))
 _dialects = { '.csv': 'excel', '.txt': 'excel-tab' }
+_CHUNK = 1<<22 # bytes per range parsed by one process, with *jobs*
 
 def parseHeaderedCSV(fname,header=None,intflds=[],fltflds=[],
-                     txtflds=[],delim=None,**kwds):
+                     txtflds=[],delim=None,where=None,lazyflds=(),
+                     project=None,jobs=1,chunksize=_CHUNK,derive=None,
+                     **kwds):
     '''Converts a csv file, with a header line, to a sequence of
     nameholder objects, with keys corresponding to the fields in the
     header line. This is a generator function (i.e. returns an iterator).
@@ -34,6 +40,34 @@ def parseHeaderedCSV(fname,header=None,intflds=[],fltflds=[],
     to the columns of the file. If omitted, this function assumes the
     first line of the file is a header line; otherwise, that line is taken
     to be data.
+
+    *where*, if specified, maps field names to predicates: a line is
+    skipped, before any record is made for it, unless each predicate is
+    true of its field's converted value. Those fields are converted first,
+    so a rejected line costs little more than splitting it.
+
+    *project*, if specified, is a collection of field names; other fields
+    are left out of the records (fields with conversions are always kept).
+
+    *lazyflds* names fields whose text is left in the file: the records
+    hold lazyfield objects instead, which read it back by byte offset (see
+    resolve()). This needs *fname* to name a regular file, which can be
+    read again at those offsets; for stdin, a pipe (e.g. /dev/stdin) or a
+    file object, these fields are read as usual.
+
+    *jobs*, if more than 1, is a number of processes among which to parse
+    the lines after the first, in byte ranges of about *chunksize* bytes
+    (cut at line ends). The records are yielded in the same order, and
+    errors report the same line numbers, as when parsing in this process.
+    The predicates of *where* and the conversions are applied in those
+    processes, so that only the records kept come back. This too needs
+    *fname* to name a regular file; otherwise *jobs* is ignored, and the
+    lines are parsed in this process.
+
+    *derive*, if specified, is called on each record before it is yielded
+    (e.g. to set fields computed from others); with *jobs*, it is called in
+    the parsing processes, so that the work of making the records is done
+    there too.
     '''
     def check(header):
         head = header
@@ -43,22 +77,50 @@ def parseHeaderedCSV(fname,header=None,intflds=[],fltflds=[],
                       'file {!r}; detected fields {} instead.').format(
                           ', '.join(missingfields), fname, ', '.join(head)))
         return header
-    def yieldable(tup,lineno,f):
-        if len(tup) != len(header): raise Error( 
-            'line %d in file %s does not match header:'%(lineno,f.name) +
-            delim.join(header) + '\n' + delim.join(tup))
-        try: r = nameholder(zip(header,tup),_conversions=conversions)
-        except ValueError: raise Error('Conversion error at line %d'%lineno + 
-           ', file %r' % f.name)
-        r.close() ; return r
+    def prepare(header):
+        index = dict((h,i) for i,h in enumerate(header))
+        keep = [i for i,h in enumerate(header) if project is None or
+                    h in projected or h in conversions]
+        tests = [(index[k],conversions.get(k,str),p) for k,p in where.items()]
+        lazy = [(index[k],conversions.get(k,str)) for k in lazyflds
+                if k in index and index[k] in keep] if src else []
+        rconvs = dict(conversions)
+        for k in lazyflds: rconvs.pop(k,None)
+        for k in where: rconvs.pop(k,None) # converted already, by the tests
+        return keep,tests,lazy,rconvs
+    def yieldable(tup,lineno,f,offset):
+        if len(tup) != len(header):
+            raise _mismatch(lineno,f.name,header,delim,tup)
+        try: vals = [(i,conv(tup[i])) for i,conv,pred in tests]
+        except ValueError: raise _converror(lineno,f.name)
+        if not all(pred(v) for (i,v),(_,_,pred) in zip(vals,tests)):
+            return None
+        for i,conv in lazy:
+            tup[i] = lazyfield(src,offset+sum(len(t)+1 for t in tup[:i]),
+                               len(tup[i]),conv)
+        for i,v in vals: tup[i] = v
+        try: r = nameholder([(header[i],tup[i]) for i in keep],
+                            _conversions=rconvs)
+        except ValueError: raise _converror(lineno,f.name)
+        r.close()
+        if derive is not None: derive(r)
+        return r
     conversions = dict((x,str) for x in txtflds)
     conversions.update((x,int) for x in intflds)
     conversions.update((x,float) for x in fltflds)
     conversions.update(kwds) # user-defined types / conversion functions
+    conversions = dict((k.upper(),v) for k,v in conversions.items())
+    where = dict((k.upper(),v) for k,v in (where or {}).items())
+    lazyflds = [k.upper() for k in lazyflds]
+    projected = set(k.upper() for k in (project or ()))
+    seekable = isinstance(fname,basestring) and fname != '-' and \
+               _path.isfile(fname)
+    src = source(fname) if seekable and lazyflds else None
     if header is not None: header = check(header)
-    with utils.quickopen(fname,'r') as f:
-        try: s = next(f).rstrip()
+    with utils.quickopen(fname,'r') as f, _closing(src):
+        try: first = next(f)
         except StopIteration: return # indicates file was empty
+        s = first.rstrip()
         if delim is None:
            for delim in ',\t':
                s_s = s.split(delim)
@@ -72,34 +134,251 @@ def parseHeaderedCSV(fname,header=None,intflds=[],fltflds=[],
             if len(s_s)==1: raise Error('First line of file %r' %fname +
              'improperly formatted: expected fields delimited by ' +
              names.get(delim,delim) + '\nproblem line: %r'%s)
-        if header is None: header = check(s_s)
-        else: yield yieldable(s_s,1,f)
+        headerline = header is None
+        if headerline: header = check(s_s)
+        missing = [k for k in where if k not in header]
+        if missing: raise Error('Fields ({}) not found in file {!r}'.format(
+                                 ', '.join(missing),fname))
+        keep,tests,lazy,rconvs = prepare(header)
+        if not headerline:
+            r = yieldable(s_s,1,f,0)
+            if r is not None: yield r
+        offset = len(first)
+        if jobs > 1 and seekable:
+            for r in _parallel(fname,src,(delim,header,keep,tests,lazy,
+                               rconvs,derive),offset,jobs,chunksize): yield r
+            return
         for line,rec in enumerate(f,2):
-            yield yieldable(rec.rstrip().split(delim),line,f)
+            r = yieldable(rec.rstrip().split(delim),line,f,offset)
+            if r is not None: yield r
+            offset += len(rec)
+
+def _mismatch(lineno,name,header,delim,tup):
+    return Error('line %d in file %s does not match header:'%(lineno,name) +
+                 delim.join(header) + '\n' + delim.join(tup))
+def _converror(lineno,name):
+    return Error('Conversion error at line %d'%lineno + ', file %r' % name)
+
+def _parallel(fname,source,job,offset,jobs,chunksize):
+    '''Yields the records of the lines of *fname* from byte *offset* on,
+    parsed by a pool of *jobs* processes; *job* is the settings made by
+    parseHeaderedCSV(). At most two ranges per process are parsed ahead of
+    the records yielded. The processes make the records, which come back
+    as (keys,hidden keys,values) with lazy fields as (offset,length); here
+    they are only put back together, by nameholder.fromstate().'''
+    delim,header,keep,tests,lazy,rconvs,derive = job
+    lazykeys = [(header[i],conv) for i,conv in lazy]
+    shapes,fromstate = {},nameholder.fromstate
+    ranges = _ranges(fname,offset,chunksize)
+    # the processes are forked with the settings, which may hold lambdas
+    pool = _mp.Pool(jobs,_setrangejob,((fname,)+job,))
+    try:
+        pending = _coll.deque(pool.apply_async(_parserange,(r,))
+                              for r in _it.islice(ranges,2*jobs))
+        lineno = 2
+        while pending:
+            rows,nlines,err = pending.popleft().get()
+            for r in _it.islice(ranges,1):
+                pending.append(pool.apply_async(_parserange,(r,)))
+            for keys,hidden,values in rows:
+                if keys not in shapes: shapes[keys] = [(keys.index(k),conv)
+                                           for k,conv in lazykeys if k in keys]
+                for j,conv in shapes[keys]:
+                    values[j] = lazyfield(source,values[j][0],values[j][1],
+                                          conv)
+                yield fromstate(zip(keys,values),hidden,False,rconvs)
+            if err is not None:
+                if err[1] is None: raise _converror(lineno+err[0],fname)
+                raise _mismatch(lineno+err[0],fname,header,delim,err[1])
+            lineno += nlines
+    finally:
+        pool.terminate() ; pool.join() ; ranges.close()
+
+def _ranges(fname,start,chunksize):
+    '''Yields (start,end) byte ranges of *fname* from *start* on, of about
+    *chunksize* bytes, each ending at the end of a line.'''
+    with open(fname,'rb') as f:
+        size = _os.fstat(f.fileno()).st_size
+        if size <= start: return
+        mm = _mmap.mmap(f.fileno(),0,access=_mmap.ACCESS_READ)
+        try:
+            while start < size:
+                end = mm.find('\n',min(start+chunksize,size)-1)+1 or size
+                yield start,end ; start = end
+        finally: mm.close()
+
+_rangejob = None # the settings of _parallel(), in the processes of its pool
+def _setrangejob(job):
+    global _rangejob ; _rangejob = job
+
+def _parserange(span):
+    '''Parses the lines in the byte range *span* of the file, as
+    parseHeaderedCSV() does. Returns (rows,lines,error): the records kept,
+    each as (keys,hidden keys,values) with lazy fields as (offset,length);
+    the number of lines; and, at the first bad line, in which case the rows
+    are those before it, (its index,None) for a conversion error or (its
+    index,its fields) if it does not match the header.'''
+    fname,delim,header,keep,tests,lazy,rconvs,derive = _rangejob
+    start,end = span
+    with open(fname,'rb') as f:
+        mm = _mmap.mmap(f.fileno(),0,access=_mmap.ACCESS_READ)
+        try: text = mm[start:end]
+        finally: mm.close()
+    lines = text.split('\n')
+    if not lines[-1]: lines.pop()
+    keys,convs = [header[i] for i in keep],[rconvs.get(header[i]) for i in keep]
+    src,shapes = source(fname),{}
+    rows,offset = [],start
+    for n,line in enumerate(lines):
+        tup = line.rstrip().split(delim)
+        if len(tup) != len(header): return rows,n,(n,tup)
+        try: vals = [(i,conv(tup[i])) for i,conv,pred in tests]
+        except ValueError: return rows,n,(n,None)
+        if all(pred(v) for (i,v),(_,_,pred) in zip(vals,tests)):
+            for i,conv in lazy:
+                tup[i] = lazyfield(src,offset+sum(len(t)+1 for t in tup[:i]),
+                                   len(tup[i]),conv)
+            for i,v in vals: tup[i] = v
+            try: values = [tup[i] if conv is None else conv(tup[i])
+                           for i,conv in zip(keep,convs)]
+            except ValueError: return rows,n,(n,None)
+            r = nameholder.fromstate(zip(keys,values),(),False,rconvs)
+            if derive is not None: derive(r)
+            rows.append(_shape(r,shapes))
+        offset += len(line) + 1
+    return rows,len(lines),None
 
-def writetocsv(seq,outname,overwrite):
-    '''Takes a sequence of nameholder records and writes them to the specified
-    output file. The 'overwrite' parameter specifies how to handle a filename
-    that already exists; also, if overwrite is equal to DONT_ALL, function
-    returns immediately.
+def _shape(r,shapes):
+    '''Returns the record *r* as (keys,hidden keys,values), the values of
+    lazy fields as (offset,length); records of the same keys share them.'''
+    keys,shown = tuple(r.iterkeys()),set(r.fields())
+    shape = keys,tuple(k for k in keys if k not in shown)
+    shape,values = shapes.setdefault(shape,shape),r.values()
+    for j,v in enumerate(values):
+        if isinstance(v,lazyfield): values[j] = v.span()
+    return shape+(values,)
+
+class lazyfield(object):
+    '''Stands for a field value which parseHeaderedCSV() left in the file:
+    *length* characters at byte *offset*, to be converted by *conv*. Use
+    resolve() to get the value; str() gives its text.'''
+    __slots__ = ('_src','_off','_len','_conv')
+    def __init__(self,src,offset,length,conv=str):
+        self._src,self._off,self._len,self._conv = src,offset,length,conv
+    def value(self): return self._conv(self._src.read(self._off,self._len))
+    def span(self):
+        '''Returns (offset,length): where the text is in the file.'''
+        return self._off,self._len
+    def __str__(self): return str(self.value())
+    def __len__(self): return self._len
+    def __repr__(self): return 'lazyfield({!r},{},{})'.format(
+                                   self._src.name,self._off,self._len)
+
+class _source(object):
+    '''A file from which lazyfields are read, opened on first use. There is
+    one per file name (see source()), which unpickled lazyfields share.'''
+    def __init__(self,fname): self.__setstate__(fname)
+    def read(self,offset,length):
+        with self._lock:
+            if self._f is None: self._f = open(self.name,'rb')
+            self._f.seek(offset) ; return self._f.read(length)
+    def close(self):
+        '''Closes the file; the next read opens it again.'''
+        with self._lock:
+            if self._f is not None: self._f.close() ; self._f = None
+    def __del__(self): self.close()
+    def __reduce__(self): return (source,(self.name,))
+    def __setstate__(self,name):
+        self.name,self._f,self._lock = name,None,_threading.Lock()
+
+@_contextlib.contextmanager
+def _closing(source):
+    try: yield source
+    finally:
+        if source is not None: source.close()
+
+def source(fname):
+    '''Returns an object from which lazyfields of the file *fname* can be
+    read, as lazyfield(source(fname),offset,length,conv). It is the same
+    object for the same name as long as any of its lazyfields is alive, so
+    that there is one open file per name however many there are.'''
+    with _sourcelock:
+        src = _sources.get(fname)
+        if src is None: src = _sources[fname] = _source(fname)
+        return src
+_sources,_sourcelock = _weakref.WeakValueDictionary(),_threading.Lock()
+
+def resolve(value):
+    '''Returns the value a lazyfield stands for; other values are returned
+    unchanged.'''
+    return value.value() if isinstance(value,lazyfield) else value
+
+def _filemode(fname):
+    '''The mode open(fname,'w') leaves a file with: its own if it exists,
+    else the default less the umask (which can only be read by setting it).'''
+    try: return _os.stat(fname).st_mode & 07777
+    except OSError:
+        umask = _os.umask(0) ; _os.umask(umask)
+        return 0666 & ~umask
+
+def writetocsv(seq,outname,overwrite,atomic=False,batchsize=1000):
+    '''Takes a sequence (or any iterable) of nameholder records and writes
+    them to the specified output file, with a header. The 'overwrite'
+    parameter specifies how to handle a filename that already exists; also,
+    if overwrite is equal to DONT_ALL, function returns immediately.
+
+    The records are written as they come, *batchsize* at a time, so they
+    need never all be in memory. The columns are the fields of the first
+    record; a later record lacking one of them raises Error when it is
+    reached, and fields of later records not among them are left out.
+
+    If *atomic* is true, the records are written to a temporary file in the
+    same directory, which replaces *outname* only once they are all written,
+    so that *outname* is never left half written. The file gets the mode a
+    plain write would have given it.
 
     Return value: 1 if a file was written, 0 if not.'''
 
-    if overwrite==DONT_ALL or not seq: return 0
-    fields = seq[0].fields() ; S = set(fields)
-    assert(all(set(s.fields()) == S for s in seq[1:]))
+    if overwrite==DONT_ALL: return 0
+    seq = iter(seq)
+    first = next(seq,None)
+    if first is None: return 0
     if _path.exists(outname):
         if not _path.isfile(outname):
             print >>_sys.stderr, _sys.argv[0]+': warning: file ',
             print >>_sys.stderr, outname, 'exists, caused a problem. skipping.'
+            return 0
         if overwrite==DONT_OVER or (overwrite==PROMPT and \
           raw_input('\nOverwrite file {!r}? (y/n) '.format(outname)) in 'nN'):
              return 0
     dirname = _path.dirname(outname)
-    if not _path.exists(dirname): _os.mkdir(dirname)
-    with open(outname,'ab') as out:
-        wr = _csv.DictWriter(out,fields,extrasaction='ignore')
-        wr.writeheader()
-        wr.writerows(seq)
+    if dirname and not _path.exists(dirname): _os.makedirs(dirname)
+    fields = first.fields()
+    def rows():
+        for n,r in enumerate(_it.chain([first],seq),1):
+            # dict.get, as the fields are already upper-case; a None may
+            # be a missing field, and only then is the record checked
+            row = map(r.get,fields)
+            if None in row:
+                missing = [k for k in fields if k not in r]
+                if missing: raise Error('record {} lacks fields {}'.format(
+                                        n,', '.join(missing)))
+            yield row
+    if atomic: out = _tempfile.NamedTemporaryFile('wb',dir=dirname or '.',
+                     prefix='.'+_path.basename(outname),suffix='.tmp',
+                     delete=False)
+    else: out = open(outname,'wb')
+    try:
+        with out:
+            wr = _csv.writer(out)
+            wr.writerow(fields)
+            rows = rows()
+            for batch in iter(lambda: list(_it.islice(rows,batchsize)),[]):
+                wr.writerows(batch)
+        if atomic:
+            _os.chmod(out.name,_filemode(outname))
+            _os.rename(out.name,outname)
+    except:
+        if atomic: _os.remove(out.name)
+        raise
     return 1
-
@@ -0,0 +1,88 @@
+'''dedup.py
+
+Collapses the entries of the extraction output whose sequences are exactly
+alike. Young transposon families leave many identical copies, each of which
+would otherwise be an entry of its own for the aligner to align. A
+dedupwriter stands in for the fasta object given to
+classify.full_transposon_treatment() (as align.alignpool does): it keeps the
+first entry with each SEQ, by its md5, as the representative of the others.
+Once closed, it writes the representatives to the real output in the order
+they were first seen, with titles like
+
+  >scaf1_100-900_standalone[0] count=2; loci=scaf1:100..900,scaf7:20..820;
+
+(attributes as read by fasta objects with parse=FULL), and writes a map from
+every entry to its representative to a tab-separated sidecar file, from
+which expand() restores the full output -- or the full alignment, when
+given the aligned representatives.
+'''
+
+import csv as _csv, hashlib as _hashlib, re as _re
+import fasta
+
+class Error(Exception):
+    """Special exception class thrown by functions in this module."""
+
+_namepattern = _re.compile(r'(.+)_(\d+)-(\d+)_[^_]+$') # see classify.setname
+_island = _re.compile(r'_\d+$') # the island number, see classify.makeislands
+_mapfields = ('NAME','REPRESENTATIVE')
+
+def locusof(entry):
+    '''Returns the locus (as a string; see fasta.locus) of an entry made by
+    the extraction, from its SSEQID, SSTART and SEND if it has them, or
+    else from its name, without the island number the extraction adds to
+    the scaffold's name. Returns the name if it has no locus in it.'''
+    if all(k in entry for k in ('SSEQID','SSTART','SEND')):
+        sseqid,(start,end) = entry.SSEQID,sorted((entry.SSTART,entry.SEND))
+    else:
+        m = _namepattern.match(entry.NAME)
+        if m is None: return entry.NAME
+        sseqid,start,end = m.group(1),int(m.group(2)),int(m.group(3))
+    return str(fasta.locus(_island.sub('',sseqid),start,end))
+
+class dedupwriter(object):
+    '''Keeps one entry of those written to it for each distinct SEQ, and on
+    closing writes those to *out* (a writeable fasta object) with COUNT and
+    LOCI attributes, and the map from each entry written to its
+    representative to the file *mapname*. *out* is left open.'''
+    def __init__(self,out,mapname):
+        self._out,self._mapname = out,mapname
+        self._reps,self._order,self._map = {},[],[]
+    def writeentries(self,entries,parse=None):
+        for e in entries: self.writeentry(e)
+    def writeentry(self,entry,parse=None):
+        key = _hashlib.md5(str(entry.SEQ)).digest()
+        rep = self._reps.get(key)
+        if rep is None:
+            rep = self._reps[key] = (entry,[]) ; self._order.append(rep)
+        rep[1].append(locusof(entry))
+        self._map.append((entry.NAME,rep[0].NAME))
+    def close(self):
+        '''Writes out the representatives and the map.'''
+        for e,loci in self._order:
+            self._out.writeentry(fasta.seq_entry([('NAME',e.NAME),
+                ('COUNT',len(loci)),('LOCI',','.join(loci)),('SEQ',e.SEQ)]),
+                parse=fasta.FULL)
+        with open(self._mapname,'wb') as f:
+            wr = _csv.writer(f,dialect='excel-tab',lineterminator='\n')
+            wr.writerow(_mapfields) ; wr.writerows(self._map)
+        self._reps,self._order,self._map = {},[],[]
+    def __enter__(self): return self
+    def __exit__(self,type,value,traceback):
+        if type is None: self.close()
+
+def expand(src,mapname,out):
+    '''Writes to *out* (a writeable fasta object) an entry for each entry
+    named in the map *mapname*, in its order, with the sequence of its
+    representative in *src* (a readable fasta object, e.g. of the aligned
+    output of a dedupwriter; the representatives are known by the first
+    word of their titles). Raises Error if a representative is missing.'''
+    seqs = dict((e.NAME.split(None,1)[0],e.SEQ) for e in src)
+    with open(mapname,'rU') as f:
+        rd = _csv.reader(f,dialect='excel-tab')
+        if tuple(next(rd,())) != _mapfields:
+            raise Error('{!r} is not a dedup map'.format(mapname))
+        for name,rep in rd:
+            if rep not in seqs:
+                raise Error('representative {!r} not found'.format(rep))
+            out.writeentry(fasta.seq_entry([('NAME',name),('SEQ',seqs[rep])]))
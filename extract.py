@@ -20,11 +20,12 @@ this file.
 '''
 
 defaults = { 'max_overlap' : (int,1), 'min_distance' : (int,5000),
-             'min_length' : (int,-1), 'evalue_threshold': (float,0.0) }
+             'min_length' : (int,-1), 'evalue_threshold': (float,None) }
 
 def maybeint(x): return x if x is None else int(x)
 
-import classify, argparse, sys, fasta, itertools as it, os
+import classify, argparse, sys, fasta, itertools as it, os, utils, csv
+import multiprocessing, align, dedup
 __doc__ = __doc__.replace('[FIELDS_GO_HERE]', ', '.join(classify.allflds))
 
 def makeparser(parser=None):
@@ -71,11 +72,129 @@ def makeparser(parser=None):
         they are part of a nest. If this option is omitted, any overlap
         whatever will trigger a nest relationship, while specifying a
         higher number allows insignificant overlaps to be ignored.''')
+  parser.add_argument('--sweep',action='store_true',help='''
+        Parameter sweep: -d, -p, -l and -e each take a comma-separated list
+        of values (e.g. -d 1000,5000,20000), and the extraction is done for
+        every combination of them, reading the hits only once. Each
+        combination is written to its own file, named after the output
+        file with the settings added (e.g. out.d5000.p1.l-1.enone.fa), and
+        a table of the islands, nests and entries of each to OUT.sweep.tsv.
+        Requires --out.''')
+  parser.add_argument('--top-k',type=int,metavar='N',help='''
+        Write only the N best islands -- those whose best hit has the
+        lowest evalue, and then the greatest length -- of the whole
+        genome, or of each scaffold with --per-scaffold. The other islands
+        are dropped without being classified, which makes for a quick
+        first look at a large genome.''')
+  parser.add_argument('--per-scaffold',action='store_true',help='''
+        With --top-k, keep the best islands of each scaffold.''')
+  parser.add_argument('--align',metavar='CMD',help='''
+        Multiple aligner to run on the output as it is produced, e.g.
+        --align=ginsi: each island's entries are aligned by their own run
+        of CMD (given the name of a fasta file, in place of {} or else at
+        the end, and writing the alignment to stdout), alongside the
+        extraction, and the alignments written in order.''')
+  parser.add_argument('--align-jobs',type=int,help='''
+        Number of aligners to run at once, with --align. Defaults to the
+        number of processors on this machine.''')
+  parser.add_argument('--dedup',metavar='MAP',help='''
+        Write only one entry for each distinct sequence, titled with the
+        number of entries it stands for and their loci (e.g. count=3;
+        loci=scaf1:100..900,...;), and write to MAP a table of the entry
+        each of the others was collapsed into, from which
+        'blastextract.py expand' restores them (e.g. after alignment).''')
+  parser.add_argument('--cache',action='store_true',help='''
+        Keep the parsed hits in a cache next to the input file (as
+        FILE.pcache), so that extracting from the same file again skips
+        parsing it. The cache is rebuilt whenever the file changes.''')
+  parser.add_argument('--cache-dir',help='''
+        Like --cache, but keeps the cache in the given directory.''')
+  parser.add_argument('--cache-size',default='4G',help='''
+        Largest total size (e.g. 512M or 4G) of the caches in the
+        --cache-dir directory; the least recently used are removed.
+        Defaults to 4G.''')
+  parser.add_argument('--sort-mem',help='''
+        Memory to use (e.g. 512M or 4G) for sorting the hits by subject
+        sequence, which lets the hits be treated one scaffold at a
+        time. Runs larger than this are sorted on disk, in $TMPDIR. If
+        omitted, all hits are held in memory at once.''')
+  parser.add_argument('--packed',action='store_true',help='''
+        Hold hit sequences in memory packed two bits to a base, which
+        takes about a quarter of the memory for long hits.''')
+  parser.add_argument('--parse-jobs',type=int,default=1,help='''
+        Number of processes among which to parse the input file (not
+        stdin), for large files. Defaults to 1.''')
+  parser.add_argument('--write-queue',type=int,default=0,help='''
+        Write the output on a thread of its own, so that the next island
+        is extracted while the last is written (e.g. to a slow disk or
+        pipe), with at most this many islands waiting. Defaults to 0,
+        i.e. writing each island before going on.''')
   return parser
 
+def cachedir(args):
+    '''The *cache* argument of customcsv.parseHeaderedCSV() for --cache and
+    --cache-dir.'''
+    return args.cache_dir or ('' if args.cache else None)
+
+def sweepname(out,key):
+    '''The output file for the settings *key* (gap,overlap,minlength,evalue)
+    of a sweep whose output file is *out*.'''
+    base,ext = os.path.splitext(out)
+    gap,overlap,minlength,evalue = key
+    return '{}.d{}.p{}.l{}.e{}{}'.format(base,gap,overlap,minlength,
+                            'none' if evalue is None else evalue,ext or '.fa')
+
+def sweep(parser,args):
+    '''Runs extract.py --sweep; see classify.sweep().'''
+    if args.out == '-': parser.error('--sweep requires --out')
+    if args.align: parser.error('--align cannot be used with --sweep')
+    if args.dedup: parser.error('--dedup cannot be used with --sweep')
+    if args.top_k: parser.error('--top-k cannot be used with --sweep')
+    for k,(T,v) in sorted(defaults.iteritems()):
+        given = getattr(args,k)
+        try: vals = [v] if given is None else map(T,given.split(','))
+        except ValueError: parser.error('bad type for --{} (got {})'.format(
+                                        k.replace('_','-'),given))
+        if 0 in vals and k != 'evalue_threshold':
+            parser.error('0 not a valid arg')
+        setattr(args,k,vals)
+    evalue = None if None in args.evalue_threshold else \
+             max(args.evalue_threshold)
+    hits = classify.hitsfromcsv(args.file,lazyseq=True,evalue=evalue,
+                                fields=classify.allflds,packed=args.packed,
+                                cache=cachedir(args),cachesize=args.cache_size,
+                                jobs=args.parse_jobs)
+    outs = {}
+    def fastaout(*key):
+        if key not in outs: outs[key] = fasta.fasta(sweepname(args.out,key),
+                                           args.mode,queue=args.write_queue)
+        return outs[key]
+    try:
+        counts = classify.sweep(hits,args.min_distance,args.max_overlap,
+                                args.min_length,args.evalue_threshold,fastaout)
+    finally:
+        for f in outs.itervalues(): f.close()
+    with open(os.path.splitext(args.out)[0]+'.sweep.tsv','w') as f:
+        wr = csv.writer(f,dialect='excel-tab',lineterminator='\n')
+        wr.writerow(('MIN_DISTANCE','MAX_OVERLAP','MIN_LENGTH',
+                     'EVALUE_THRESHOLD','ISLANDS','NESTS','ENTRIES','FILE'))
+        for key in sorted(counts):
+            if key not in outs: fastaout(*key).close() # no hits at all
+            c = counts[key]
+            wr.writerow(key + (c['ISLANDS'],c['NESTS'],c['ENTRIES'],
+                               sweepname(args.out,key)))
+
 if __name__=='__main__' and not sys.flags.interactive:
     parser = makeparser()
     args = parser.parse_args()
+    for k in ('sort_mem','cache_size'):
+        given = getattr(args,k)
+        try: setattr(args,k,given and utils.parsesize(given))
+        except ValueError:
+            parser.print_usage()
+            sys.exit('{}: error: bad size for --{} (got {})'.format(
+                         parser.prog,k.replace('_','-'),given))
+    if args.sweep: sys.exit(sweep(parser,args))
     if 0 in (args.max_overlap,args.min_distance,args.min_length):
         parser.print_usage()
         sys.exit(parser.prog+': error: 0 not a valid arg')
@@ -86,12 +205,33 @@ if __name__=='__main__' and not sys.flags.interactive:
             parser.print_usage()
             sys.exit('{}: error: bad type for --{} (got {})'.format(
                                    parser.prog,k.replace('_','-'),given))
-    with fasta.fasta(args.out,args.mode) as out:
-        classify.full_transposon_treatment(
-             seq = classify.hitsfromcsv(args.file),
+    hits = classify.hitsfromcsv(args.file,lazyseq=True,
+                                evalue=args.evalue_threshold,
+                                fields=classify.allflds,packed=args.packed,
+                                cache=cachedir(args),cachesize=args.cache_size,
+                                jobs=args.parse_jobs)
+    if args.sort_mem: hits = classify.sortedhits(hits,maxmem=args.sort_mem)
+    align_jobs = multiprocessing.cpu_count() if args.align_jobs is None \
+                 else args.align_jobs
+    if align_jobs < 1: parser.error('--align-jobs must be at least 1')
+    if args.align and args.dedup:
+        parser.error('--dedup cannot be used with --align')
+    if args.top_k is not None and args.top_k < 1:
+        parser.error('--top-k must be at least 1')
+    treatment = dict(
+             seq = hits,
+             presorted = bool(args.sort_mem),
              overlap = args.max_overlap,
              gap = args.min_distance,
              minlength = args.min_length,
              evalue = args.evalue_threshold,
-             fastaout = out
-        )
+             topk = args.top_k,
+             perscaffold = args.per_scaffold)
+    with fasta.fasta(args.out,args.mode,queue=args.write_queue) as out:
+        if args.align:
+            with align.alignpool(args.align,out,align_jobs) as pool:
+                classify.full_transposon_treatment(fastaout=pool,**treatment)
+        elif args.dedup:
+            with dedup.dedupwriter(out,args.dedup) as writer:
+                classify.full_transposon_treatment(fastaout=writer,**treatment)
+        else: classify.full_transposon_treatment(fastaout=out,**treatment)
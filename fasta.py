@@ -3,6 +3,8 @@ try: from cStringIO import StringIO
 except ImportError: from StringIO import StringIO
 import collections as _coll, contextlib as _cont, itertools as _it
 import operator as _op, re as _re, sys as _sys
+import threading as _threading, Queue as _Queue
+from packedseq import packedseq
 from future_builtins import map
 
 class Error(Exception): pass
@@ -37,9 +39,11 @@ class locus:
     def __repr__(self): return 'locus({})'.format(self)
 _prop_pattern = _re.compile(r'([^=;]+)=([^=;]+);$')
 _convs = dict(loc=locus,length=int)
+_packed_convs = dict(_convs,seq=packedseq)
 class seq_entry(nameholder):
-    def __init__(self,src,parse_fully=False):
-        super(seq_entry,self).__init__(_conversions=_convs)
+    def __init__(self,src,parse_fully=False,packed=False):
+        super(seq_entry,self).__init__(
+            _conversions=_packed_convs if packed else _convs)
         err = 'seq_entry must be initialized with mapping type, sequence of' +\
               ' key-value pairs, or fasta-style string'
         if isinstance(src,_coll.Mapping):
@@ -78,10 +82,9 @@ class seq_entry(nameholder):
         if parse==FULL: f.write(' '+' '.join('{}={};'.format(k.lower(),self[k])
                 for k in self.fields() if k != 'NAME' and 'SEQ' not in k))
         f.write(endline)
-        if not self.SEQ: return
-        for n,c in enumerate(self.SEQ,1):
-            f.write(c + (endline if n%line_width==0 else ''))
-        if n%line_width!=0: f.write(endline)
+        seq = str(self.SEQ)
+        for i in xrange(0,len(seq),line_width):
+            f.write(seq[i:i+line_width] + endline)
     def tostring(parse=BASIC,endline='\n',line_width=80):
         if parse not in self._str:
             with _cont.closing(StringIO()) as f:
@@ -90,6 +93,68 @@ class seq_entry(nameholder):
         return self._str[parse]
     def __repr__(self): return "seq_entry(name={0.NAME},seq={1})".format(
                  self , self.SEQ if len(self.SEQ)<20 else self.SEQ[:15]+'...')
+
+class lazy_seq_entry(seq_entry):
+    '''A seq_entry built from a title line and a list of sequence lines,
+    which puts off the work of parsing the title's attributes until one is
+    asked for, and that of joining the sequence until SEQ is; reading NAME
+    is always cheap, and so is filtering on an attribute. A title with
+    malformed attributes raises FastaParseError, for the file and line the
+    entry came from, when they are first asked for, rather than when the
+    entry is read. (Code that reads the underlying dict directly sees only
+    what has been asked for.) Made by fasta objects opened with lazy=True.
+    '''
+    def __init__(self,title,lines,parse_fully=False,packed=False,
+                 file=None,lineno=None):
+        nameholder.__init__(self,
+                            _conversions=_packed_convs if packed else _convs)
+        name,rest = (title,'')
+        if parse_fully: name,rest = (title.split(None,1)+[''])[:2]
+        self._attrs = self._lines = None
+        self['NAME'],self._str = name,{}
+        self._attrs,self._lines,self._where = rest,lines,(title,lineno,file)
+    def _forceattrs(self):
+        if self._attrs is None: return
+        props = self._attrs.split()
+        mlist = list(map(_prop_pattern.match,props))
+        if None in mlist:
+            title,lineno,file = self._where
+            raise FastaParseError(line='>'+title,lineno=lineno,file=file,
+                msg='expect all attributes in title line to have form '
+                    '"key=value;".')
+        self._attrs,items = None,[(m.group(1),m.group(2)) for m in mlist]
+        if self._lines is None: # SEQ is in already, and goes after them
+            items.append(('SEQ',seq_entry.__getitem__(self,'SEQ')))
+            nameholder.__delitem__(self,'SEQ')
+        for k,v in items: nameholder.__setitem__(self,k,v)
+    def _forceseq(self):
+        if self._lines is None: return
+        lines,self._lines = self._lines,None
+        nameholder.__setitem__(self,'SEQ',''.join(lines))
+    def _force(self,key=None):
+        '''Does the work put off that *key* needs (all of it, for None).'''
+        key = None if key is None else key.upper()
+        if key not in ('NAME','SEQ'): self._forceattrs()
+        if key in (None,'SEQ'): self._forceseq()
+    def __getitem__(self,key):
+        self._force(key) ; return seq_entry.__getitem__(self,key)
+    def __contains__(self,key):
+        self._force(key) ; return seq_entry.__contains__(self,key)
+    def get(self,key,default=None):
+        self._force(key) ; return seq_entry.get(self,key,default)
+    def __setitem__(self,key,value):
+        self._force() ; seq_entry.__setitem__(self,key,value)
+    def __delitem__(self,key):
+        self._force() ; seq_entry.__delitem__(self,key)
+    def __iter__(self):
+        self._force() ; return seq_entry.__iter__(self)
+    def __len__(self):
+        self._force() ; return seq_entry.__len__(self)
+    def __eq__(self,other):
+        self._force() ; return seq_entry.__eq__(self,other)
+    def __ne__(self,other): return not self == other
+    def popitem(self,last=True):
+        self._force() ; return seq_entry.popitem(self,last)
 def _myopen_r(fname): return _sys.stdin if fname=='-' else open(fname,'rU')
 def _myopen_a(fname): return _sys.stdout if fname=='-' else open(fname,'a')
 def _myopen_w(fname): return _sys.stdout if fname=='-' else open(fname,'w')
@@ -102,7 +167,8 @@ _names['s'],_names['f'] = lambda x: '<string obj>',_op.attrgetter('name')
 class fasta:
     def _err(self,msg): raise FastaParseError(msg=msg,line=self._line,
                                    file=self._name,lineno=self._lineno)
-    def __init__(self,src=None,mode=None,parse=BASIC,line_width=80):
+    def __init__(self,src=None,mode=None,parse=BASIC,line_width=80,
+                 lazy=False,packed=False,queue=0):
         if parse not in (RAW,BASIC,FULL): raise Error(
           '"parse" arg must be RAW, BASIC or FULL (got {!r})'.format(parse))
         if mode is None:
@@ -115,7 +181,16 @@ class fasta:
             ', '.join(map(repr,_funcs)) + ' (got %r)'%mode)
         self._f,self._mode,self._parse = _funcs[mode[0]](src),mode,parse
         self._line,self._name,self._lineno = None,_names[mode[0]](src),0
-        self._line_width = line_width
+        self._line_width,self._lazy,self._packed = line_width,lazy,packed
+        # With *queue*, entries are rendered by the caller and written out by
+        # a thread of their own, with at most *queue* buffers (one for each
+        # call of writeentries()) waiting; an error writing them is raised by
+        # the next call that writes, flushes or closes.
+        self._writer,self._error = None,None
+        if queue > 0:
+            self._queue = _Queue.Queue(queue)
+            self._writer = _threading.Thread(target=self._writeall)
+            self._writer.daemon = True ; self._writer.start()
     def _getline(self):
         self._line = next(self._f,'')
         self._lineno += bool(self._line)
@@ -124,6 +199,7 @@ class fasta:
         if not self._line: return None
         if not self._line.startswith('>'):
             self._err('expect first line of fasta sequence to begin with ">"')
+        if self._lazy: return self._readlazy()
         with _cont.closing(StringIO()) as buf:
             buf.write(self._line)
             self._getline()
@@ -131,9 +207,20 @@ class fasta:
                 if ' ' in self._line: self._err('non-title line has space')
                 buf.write(self._line)
                 self._getline()
-            try: return seq_entry(buf.getvalue(),parse_fully=self._parse==FULL)
+            try: return seq_entry(buf.getvalue(),packed=self._packed,
+                                  parse_fully=self._parse==FULL)
             except FastaAttrError as e: self._err(
               'expect all attributes in title line to have form "key=value;".')
+    def _readlazy(self):
+        title,lines,lineno = self._line.rstrip('\n')[1:],[],self._lineno
+        self._getline()
+        while self._line and not self._line.startswith('>'):
+            if ' ' in self._line: self._err('non-title line has space')
+            lines.append(self._line.rstrip('\n'))
+            self._getline()
+        return lazy_seq_entry(title,lines,parse_fully=self._parse==FULL,
+                              packed=self._packed,file=self._name,
+                              lineno=lineno)
     def next(self): 
         val = self.readentry()
         if val is None: raise StopIteration
@@ -141,26 +228,58 @@ class fasta:
 
     def __iter__(self): return self
     def readentries(self): return list(self)
-    def flush(self): return self._f.flush()
-    def close(self): return self._f.close()
+    def flush(self):
+        if self._writer is not None: self._queue.join() ; self._check()
+        return self._f.flush()
+    def close(self):
+        try:
+            if self._writer is not None:
+                self._queue.put(None) ; self._writer.join()
+                self._writer = None ; self._check()
+        finally: self._f.close()
     def __enter__(self): return self
-    def __exit__(self,type,value,traceback): return self.close()
+    def __exit__(self,type,value,traceback):
+        if type is None: return self.close()
+        try: self.close()
+        except Exception: pass # the error on the way out takes precedence
     def __repr__(self): return \
      "<{2} fasta file {0._name!r}, mode {0._mode!r} at {1:#x}>".format(
          self,id(self),'closed' if self._f.closed else 'open')
 
     def writeentry(self,entry,**kwds):
+        if self._writer is None: return self._render(self._f,entry,**kwds)
+        with _cont.closing(StringIO()) as buf:
+            self._render(buf,entry,**kwds) ; self._put(buf.getvalue())
+    def writeentries(self,entries,parse=None):
+        if self._writer is None:
+            for e in entries: self.writeentry(e,parse=parse)
+            return
+        with _cont.closing(StringIO()) as buf:
+            for e in entries: self._render(buf,e,parse=parse)
+            self._put(buf.getvalue())
+    def _render(self,f,entry,**kwds):
         for kwd in ('parse','line_width'):
            if kwds.get(kwd) is None: kwds[kwd] = getattr(self,'_'+kwd)
-        if kwds['parse'] == RAW: self._f.write(entry)
+        if kwds['parse'] == RAW: f.write(entry)
         elif kwds['parse'] in (BASIC,FULL):
             if not isinstance(entry,seq_entry): raise TypeError(
                   'can only write items of seq_entry type (got %r)'%entry)
-            entry.writeto(self._f,**kwds)
+            entry.writeto(f,**kwds)
         else: raise ValueError('"parse" arg must be RAW, BASIC or FULL ' +
                           '(got {!r})'.format(kwds['parse']))
-    def writeentries(self,entries,parse=None):
-        for e in entries: self.writeentry(e,parse=parse)
+    def _put(self,buf):
+        self._check() ; self._queue.put(buf)
+    def _writeall(self):
+        while True:
+            buf = self._queue.get()
+            try:
+                if buf is None: return
+                if self._error is None: self._f.write(buf)
+            except Exception: self._error = _sys.exc_info()
+            finally: self._queue.task_done()
+    def _check(self):
+        if self._error is not None:
+            t,v,tb = self._error ; raise t,v,tb
 
 def quick_entry(name,seq,parse_fully=False):
     return fasta.seq_entry(dict(NAME=name,SEQ=seq),parse_fully)
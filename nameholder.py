@@ -1,5 +1,5 @@
 _id = lambda x: x
-import collections as _coll
+import collections as _coll, copy_reg as _copy_reg
 class nameholder(_coll.OrderedDict):
     '''Class that extends dict, with property that __getattr__ is an
     alias for __getitem__. Thus, if nh associates the value 42 to the
@@ -48,6 +48,27 @@ class nameholder(_coll.OrderedDict):
         for k,v in list(getattr(it,'items',lambda: it)()) + kwds.items():
             self[k] = v
     def copy(self): return nameholder(self)
+    def __reduce__(self):
+        # conversions are not pickled (they may be lambdas); like copy(), the
+        # result applies none to values set later.
+        return (_copy_reg.__newobj__,(type(self),),
+                (self.items(),self._ignore,self._open))
+    def __setstate__(self,state):
+        items,ignore,isopen = state
+        _coll.OrderedDict.__init__(self)
+        self._convs = _coll.defaultdict(lambda: _id)
+        for k,v in items: _coll.OrderedDict.__setitem__(self,k,v)
+        self._ignore,self._open = set(ignore),isopen
+    @classmethod
+    def fromstate(cls,items,ignore=(),isopen=True,_conversions=None):
+        '''Makes a nameholder from *items*, (key,value) pairs whose keys are
+        upper-case and whose values are already converted, with the keys
+        *ignore* hidden. Much faster than the constructor, which converts
+        each key and value; used to restore records saved in a cache.'''
+        self = cls.__new__(cls)
+        self.__setstate__((items,ignore,isopen))
+        if _conversions: self._convs.update(_conversions)
+        return self
     def hide(self,key): 
         key = key.upper()
         if key not in self: raise KeyError('key %r not in dict'%key)
@@ -0,0 +1,143 @@
+'''packedseq.py
+
+Nucleotide sequences stored in two bits per base, for holding many long
+sequences (e.g. the SSEQ of a genome's worth of hits) in memory. A packedseq
+keeps A, C, G and T in a bytearray, four to a byte; anything else -- gaps,
+N and other IUPAC codes -- is kept in a side table of runs, and so is
+lower-case (masked) sequence. Slices are views sharing the same storage, so
+that truncating a sequence copies nothing.
+
+A packedseq converts to its text with str(); it also supports len(),
+indexing and slicing, comparison with strings, reverse_complement(), and the
+gap-aware trimming used by classify (see lstrip_bases() and rstrip_bases()).
+'''
+
+import bisect as _bisect, itertools as _it, re as _re, string as _string
+
+_bases = 'ACGT'
+_enc4 = dict((''.join(k),sum(_bases.index(c)<<2*i for i,c in enumerate(k)))
+             for k in _it.product(_bases,repeat=4))
+_dec4 = [''.join(_bases[b>>2*i & 3] for i in xrange(4)) for b in xrange(256)]
+_other,_lower = _re.compile(r'([^ACGT])\1*'),_re.compile(r'[a-z]+')
+_complement = _string.maketrans('ACGTRYKMBVDHNacgtrykmbvdhn',
+                                'TGCAYRMKVBHDNtgcayrmkvbhdn')
+_GAP = '-'
+
+class packedseq(object):
+    '''A nucleotide sequence, packed two bits to a base. Made from a
+    string (or another packedseq); str() gives the text back.'''
+    __slots__ = ('_data','_start','_stop')
+    def __init__(self,s=''):
+        if isinstance(s,packedseq):
+            self._data,self._start,self._stop = s._data,s._start,s._stop
+            return
+        up = s.upper()
+        others = [(m.start(),m.end(),m.group(1)) for m in _other.finditer(up)]
+        lowers = [(m.start(),m.end()) for m in _lower.finditer(s)]
+        clean = _other.sub(lambda m: 'A'*len(m.group()),up)
+        clean += 'A'*(-len(clean)%4)
+        buf = bytearray(_enc4[clean[i:i+4]] for i in xrange(0,len(clean),4))
+        ostart,oend,ochar = zip(*others) or [(),(),()]
+        lstart,lend = zip(*lowers) or [(),()]
+        self._data = (buf,tuple(ostart),tuple(oend),''.join(ochar),
+                      tuple(lstart),tuple(lend))
+        self._start,self._stop = 0,len(s)
+    def _view(self,start,stop):
+        p = packedseq.__new__(packedseq)
+        p._data,p._start,p._stop = self._data,start,max(start,stop)
+        return p
+    def _runs(self,starts,ends,start,stop):
+        '''Yields (index,run start,run end) for runs overlapping the given
+        range, clipped to it.'''
+        i = _bisect.bisect_right(ends,start)
+        while i < len(starts) and starts[i] < stop:
+            yield i,max(starts[i],start),min(ends[i],stop) ; i += 1
+
+    def __len__(self): return self._stop - self._start
+    def __str__(self):
+        buf,ostart,oend,ochar,lstart,lend = self._data
+        a,b = self._start,self._stop
+        if a == b: return ''
+        i0 = a >> 2
+        text = ''.join(_dec4[x] for x in buf[i0:(b+3)>>2])[a-4*i0:b-4*i0]
+        pieces,pos = [],a
+        for i,s,e in self._runs(ostart,oend,a,b):
+            pieces.append(text[pos-a:s-a]) ; pieces.append(ochar[i]*(e-s))
+            pos = e
+        pieces.append(text[pos-a:])
+        if not lstart: return ''.join(pieces)
+        text,pieces,pos = ''.join(pieces),[],a
+        for i,s,e in self._runs(lstart,lend,a,b):
+            pieces.append(text[pos-a:s-a])
+            pieces.append(text[s-a:e-a].lower())
+            pos = e
+        pieces.append(text[pos-a:])
+        return ''.join(pieces)
+    def __repr__(self):
+        s = str(self)
+        return 'packedseq({!r})'.format(s if len(s)<20 else s[:15]+'...')
+    def __getitem__(self,index):
+        if isinstance(index,slice):
+            start,stop,step = index.indices(len(self))
+            if step != 1: return packedseq(str(self)[index])
+            return self._view(self._start+start,self._start+stop)
+        if index < 0: index += len(self)
+        if not 0 <= index < len(self): raise IndexError('index out of range')
+        return str(self._view(self._start+index,self._start+index+1))
+    def __iter__(self): return iter(str(self))
+    def __eq__(self,other):
+        if not isinstance(other,(packedseq,basestring)): return NotImplemented
+        return str(self) == str(other)
+    def __ne__(self,other):
+        eq = self.__eq__(other)
+        return eq if eq is NotImplemented else not eq
+    def __hash__(self): return hash(str(self))
+    def __add__(self,other): return str(self) + str(other)
+    def __radd__(self,other): return str(other) + str(self)
+    # pickled packed (as from the processes of customcsv.parseHeaderedCSV),
+    # unless a view of a longer sequence, which is pickled as its text
+    def __getstate__(self):
+        if self._start or len(self._data[0]) > (self._stop+3)>>2:
+            return str(self)
+        return self._data,self._stop
+    def __setstate__(self,state):
+        if isinstance(state,basestring): packedseq.__init__(self,state)
+        else: (self._data,self._stop),self._start = state,0
+
+    def reverse_complement(self):
+        '''Returns the reverse complement, as a new packedseq.'''
+        return packedseq(str(self).translate(_complement)[::-1])
+    def gaps(self):
+        '''Returns the number of gap characters ('-').'''
+        buf,ostart,oend,ochar = self._data[:4]
+        return sum(e-s for i,s,e in self._runs(ostart,oend,self._start,
+                                               self._stop) if ochar[i]==_GAP)
+    def nbases(self):
+        '''Returns the number of characters that are not gaps.'''
+        return len(self) - self.gaps()
+    def _gapruns(self):
+        buf,ostart,oend,ochar = self._data[:4]
+        return [(s,e) for i,s,e in self._runs(ostart,oend,self._start,
+                                              self._stop) if ochar[i]==_GAP]
+    def _base_index(self,k):
+        '''Returns the (absolute) position of the k-th base (counting from
+        0), or the end of the sequence if there are not that many.'''
+        pos = self._start
+        for s,e in self._gapruns():
+            if pos + k < s: break
+            k -= s - pos ; pos = e
+        return min(pos + k,self._stop)
+    def lstrip_bases(self,n):
+        '''Removes n bases (not counting gaps) from the beginning, along
+        with the gaps before and between them, as classify.shortenhead()
+        does for strings. Raises ValueError if there are fewer than n.'''
+        if n > self.nbases(): raise ValueError('only %d bases'%self.nbases())
+        return self._view(self._base_index(n),self._stop)
+    def rstrip_bases(self,n):
+        '''Removes n bases (not counting gaps) from the end, along with
+        the gaps after and between them, as classify.shortentail() does
+        for strings. Raises ValueError if there are fewer than n.'''
+        m = self.nbases()
+        if n > m: raise ValueError('only %d bases'%m)
+        if n == m: return self._view(self._start,self._start)
+        return self._view(self._start,self._base_index(m-n-1)+1)
@@ -0,0 +1,152 @@
+'''planner.py
+
+Rough sizing of the searches and extractions run by blastextract.py: from the
+lengths of the query and subject sequences, and the processors and memory of
+this machine, makeplan() estimates what a run will cost and recommends how
+to divide the machine up (blastn -num_threads, how many searches to run at
+once, and whether extraction should sort its hits on disk rather than hold
+them all in memory). 'blastextract.py --dry-run' prints the plan, and
+--auto applies it. It does not split a search into shards: each job is one
+blastn, parallelised by -num_threads alone.
+
+The estimates are rough -- the number of hits in particular depends on how
+common the transposon is, which cannot be known in advance -- and are only
+meant to tell a two-minute run from a two-day one.
+'''
+
+import multiprocessing as _mp, os as _os, os.path as _path, struct as _struct
+import fasta
+from nameholder import nameholder
+
+# Rough rates, measured on blastn (megablast) and extract.py.
+_blast_rate = 1e-11  # cpu-seconds per (query base * subject base)
+_hit_rate = 2e-9     # hits per (query base * subject base)
+_extract_rate = 5e-4 # cpu-seconds per hit
+_hit_bytes = 2048    # memory per hit, besides its sequence
+_max_threads = 8     # blastn gains little from more threads than this
+_min_threaded = 30   # cpu-seconds below which a search gets one thread
+
+def query_length(fname):
+    '''Returns the total length of the sequences in the fasta file.'''
+    with fasta.fasta(fname) as f: return sum(len(e.SEQ) for e in f)
+
+def subject_length(subject=None,db=None):
+    '''Returns the total length of the subject sequences: those of the
+    fasta file *subject* (read from its .fai index if there is one), or of
+    the BLAST database *db* (see db_length()).'''
+    if db is not None: return db_length(db)
+    if _path.isfile(subject+'.fai'):
+        with open(subject+'.fai') as f:
+            return sum(int(line.split('\t')[1]) for line in f if line.strip())
+    return _path.getsize(subject) # near enough, for a fasta file
+
+def db_length(db):
+    '''Returns the total length of the nucleotide BLAST database *db*, found
+    as blastn would (as a path, or in $BLASTDB). Reads the header of each
+    volume's .nin file; failing that, guesses from the size of its .nsq
+    file, which holds four bases to a byte. Returns None if the database
+    cannot be found.'''
+    dirs = [''] + _os.environ.get('BLASTDB','').split(_os.pathsep)
+    for d in dirs:
+        base = _path.join(d,db) if d else db
+        if _path.isfile(base+'.nal'): return _alias_length(base+'.nal')
+        if _path.isfile(base+'.nin') or _path.isfile(base+'.nsq'):
+            return _volume_length(base)
+    return None
+
+def _alias_length(fname):
+    with open(fname) as f:
+        vols = next((line.split()[1:] for line in f
+                     if line.startswith('DBLIST')),[])
+    total = 0
+    for vol in vols:
+        base = _path.join(_path.dirname(fname),vol.strip('"'))
+        total += (_alias_length(base+'.nal') if _path.isfile(base+'.nal')
+                  else _volume_length(base))
+    return total
+
+def _volume_length(base):
+    try:
+        with open(base+'.nin','rb') as f:
+            version,dbtype = _struct.unpack('>ii',f.read(8))
+            if version not in (4,5): raise ValueError(version)
+            def skipstr(): f.read(_struct.unpack('>i',f.read(4))[0])
+            if version == 5: f.read(4) # volume number
+            skipstr()                  # title
+            if version == 5: skipstr() # LMDB file name
+            skipstr()                  # date
+            f.read(4)                  # number of sequences
+            return _struct.unpack('<q',f.read(8))[0]
+    except (IOError,ValueError,_struct.error):
+        try: return 4*_path.getsize(base+'.nsq')
+        except OSError: return 0
+
+def resources():
+    '''Returns (cpus,memory): the number of processors, and the bytes of
+    memory now available, on this machine.'''
+    try: mem = _os.sysconf('SC_AVPHYS_PAGES')*_os.sysconf('SC_PAGE_SIZE')
+    except (ValueError,OSError,AttributeError): mem = None
+    return _mp.cpu_count(),mem
+
+def makeplan(jobs,cpus=None,mem=None):
+    '''Estimates the cost of running the given jobs -- (query length,
+    subject length) pairs -- on *cpus* processors with *mem* bytes of
+    memory (by default, those of this machine), and recommends how to run
+    them. Returns a nameholder with the fields:
+
+    JOBS, CPUS, MEM      the inputs
+    BLAST_CPU            estimated cpu-seconds of blast search, in all
+    HITS                 estimated number of hits, in all
+    EXTRACT_CPU          estimated cpu-seconds of extraction, in all
+    THREADS              recommended blastn -num_threads per search
+    CONCURRENT           recommended number of searches to run at once
+    EXTRACTIONS          number of extractions that can run alongside them
+    SORT_MEM             memory for each extraction to sort its hits in, if
+                         they will not all fit in memory (else None)
+    WALL                 estimated seconds for the whole run
+    '''
+    mycpus,mymem = resources()
+    cpus,mem = cpus or mycpus,mem or mymem
+    plan = nameholder(JOBS=len(jobs),CPUS=cpus,MEM=mem)
+    blast = [q*s*_blast_rate for q,s in jobs]
+    hits = [q*s*_hit_rate for q,s in jobs]
+    hitmem = [h*(_hit_bytes+q) for h,(q,s) in zip(hits,jobs)]
+    plan['BLAST_CPU'],plan['HITS'] = sum(blast),int(sum(hits))
+    plan['EXTRACT_CPU'] = sum(hits)*_extract_rate
+    threads = 1 if max(blast or [0]) < _min_threaded else \
+              max(1,min(cpus,_max_threads))
+    # leave a processor for extractions, if there are processors to spare
+    spare = cpus-1 if len(jobs) > 1 and cpus > threads else cpus
+    concurrent = max(1,min(len(jobs),spare//threads))
+    plan['THREADS'],plan['CONCURRENT'] = threads,concurrent
+    plan['EXTRACTIONS'] = max(1,min(len(jobs),cpus-concurrent*threads))
+    share = mem//(2*concurrent) if mem else None
+    plan['SORT_MEM'] = share if share and max(hitmem or [0]) > share else None
+    plan['WALL'] = (sum(blast)/(concurrent*threads) +
+                    max([h*_extract_rate for h in hits] or [0]))
+    return plan
+
+def formatplan(plan):
+    '''Returns the plan as a list of lines, for people to read.'''
+    return [
+      'plan for {0.JOBS} job(s) on {0.CPUS} processor(s), {1} memory'.format(
+          plan,size(plan.MEM) if plan.MEM else 'unknown'),
+      'estimated blast: {} cpu; about {:,} hits; extraction: {} cpu'.format(
+          duration(plan.BLAST_CPU),plan.HITS,duration(plan.EXTRACT_CPU)),
+      'recommended: -num_threads {0.THREADS}, {0.CONCURRENT} search(es) at '
+      'once, up to {0.EXTRACTIONS} extraction(s) alongside'.format(plan),
+      'extraction: ' + ('in memory' if plan.SORT_MEM is None else
+          'sort hits on disk (--sort-mem {})'.format(size(plan.SORT_MEM))),
+      'estimated time: {}'.format(duration(plan.WALL))]
+
+def size(n):
+    '''Formats a number of bytes as e.g. 512M, as utils.parsesize() reads.'''
+    for unit in 'KMGT':
+        n /= 1024.
+        if n < 1024 or unit=='T': return '{:.0f}{}'.format(max(n,1),unit)
+
+def duration(s):
+    '''Formats a number of seconds for people to read.'''
+    for unit,n in (('d',86400),('h',3600),('m',60)):
+        if s >= n: return '{:.1f}{}'.format(s/n,unit)
+    return '{:.0f}s'.format(s)
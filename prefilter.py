@@ -0,0 +1,100 @@
+'''prefilter.py
+
+Narrows a blast search of a genome given as a fasta file ('blastextract.py
+--subject') to the scaffolds that may hold a copy of the query, so that
+blastn does not read through all the rest. Most scaffolds of a genome hold
+no copy of a given transposon.
+
+The subject is indexed by its k-mers, sampled every *step* bases along each
+scaffold and kept as crc32 hashes; the query gives all of its k-mers, on
+both strands. A scaffold is selected if at least *minseeds* of its sampled
+k-mers are among the query's. Any exact match of k+step-1 bases (23, with
+the default 16-mers every 8 bases) holds a sampled k-mer, so with minseeds
+1 every scaffold on which megablast -- whose seeds are exact matches of 28
+bases -- could find a hit is selected. Searches with shorter seeds (e.g.
+'-task blastn') may miss hits on the scaffolds left out.
+
+The selected scaffolds are written whole, titles and all, to a temporary
+fasta file which blastn searches instead of the subject, so that the hits
+have the coordinates of the original scaffolds.
+
+The index is cached next to the subject (as SUBJECT.pcache) or in a cache
+directory, by csvcache, and made again only if the subject changes.
+'''
+
+import array as _array, os as _os, string as _string, tempfile as _tempfile
+import zlib as _zlib
+import csvcache, fasta
+
+_K,_STEP = 16,8
+_complement = _string.maketrans('ACGT','TGCA')
+
+class Error(Exception):
+    """Special exception class thrown by functions in this module."""
+
+def buildindex(subject,k=_K,step=_STEP,cachedir=None,cachesize=None):
+    '''Returns the index of the fasta file *subject*: a list of (title,
+    array of the distinct hashes of its sampled k-mers) pairs, one per
+    scaffold, in the order of the file. It is read from the cache of
+    *subject* if there is a valid one, and otherwise made and cached.'''
+    signature = ('kmers',k,step)
+    rows = csvcache.load(subject,signature,cachedir)
+    if rows is not None:
+        return [(title,_array.array('i',hashes)) for title,hashes in rows]
+    try: writer = csvcache.writer(subject,signature,cachedir,cachesize)
+    except EnvironmentError: writer = None # then there is no cache
+    index = []
+    try:
+        with fasta.fasta(subject) as f:
+            for e in f:
+                seq = str(e.SEQ).upper()
+                hashes = _array.array('i',sorted(set(_zlib.crc32(seq[i:i+k])
+                              for i in xrange(0,len(seq)-k+1,step))))
+                index.append((e.NAME,hashes))
+                if writer: writer.add((e.NAME,hashes.tostring()))
+    except:
+        if writer: writer.discard()
+        raise
+    if writer: writer.commit()
+    return index
+
+def queryseeds(query,k=_K):
+    '''Returns the set of hashes of all the k-mers of the sequences in the
+    fasta file *query*, and of their reverse complements, leaving out those
+    with anything but A, C, G and T.'''
+    seeds = set()
+    with fasta.fasta(query) as f:
+        for e in f:
+            seq = str(e.SEQ).upper().replace('-','')
+            for s in (seq,seq.translate(_complement)[::-1]):
+                seeds.update(_zlib.crc32(s[i:i+k]) for i in xrange(len(s)-k+1)
+                             if not s[i:i+k].strip('ACGT'))
+    if not seeds: raise Error('no {}-mers in query {!r}'.format(k,query))
+    return seeds
+
+def select(index,seeds,minseeds=1):
+    '''Returns the titles of the scaffolds in *index* (see buildindex())
+    with at least *minseeds* of the hashes in *seeds*.'''
+    return [title for title,hashes in index
+            if len(seeds.intersection(hashes)) >= minseeds]
+
+def writesubset(subject,titles,out):
+    '''Writes the scaffolds of the fasta file *subject* with the given
+    titles to the fasta file *out*, unchanged and in order.'''
+    titles = set(titles)
+    with fasta.fasta(subject,lazy=True) as f, fasta.fasta(out,'w') as o:
+        o.writeentries(e for e in f if e.NAME in titles)
+
+def prefilter(query,subject,minseeds=1,k=_K,step=_STEP,cachedir=None,
+              cachesize=None):
+    '''Writes the scaffolds of *subject* selected for *query* (both fasta
+    files) to a temporary fasta file, and returns its name, for the caller
+    to remove when done with it. Returns None if no scaffold is selected.'''
+    titles = select(buildindex(subject,k,step,cachedir,cachesize),
+                    queryseeds(query,k),minseeds)
+    if not titles: return None
+    fd,name = _tempfile.mkstemp(prefix='prefilter.',suffix='.fa')
+    _os.close(fd)
+    try: writesubset(subject,titles,name)
+    except: _os.remove(name) ; raise
+    return name
@@ -0,0 +1,176 @@
+'''service.py
+
+A resident extraction service, which saves the workflow that calls extract.py
+thousands of times the cost of starting an interpreter (and re-reading the
+same hit files) for each call. Start it with 'blastextract.py serve', and
+send it jobs with submit() or 'blastextract.py submit'.
+
+The service listens on a Unix socket, or on a TCP port of localhost. Each
+connection carries one job: the client sends a line of JSON, e.g.
+
+  {"file": "hits.csv", "min_distance": 5000, "evalue_threshold": 1e-10}
+
+with any of the keys max_overlap, min_distance, min_length,
+evalue_threshold, top_k, per_scaffold and packed (as for extract.py;
+omitted keys take the same defaults). Any other key is an error.
+If "file" is absent, the hits are read from the rest of the connection
+instead, as CSV with a header. The service answers with the fasta output
+of the extraction, as it is produced, then a last line which is either
+"#ok" or "#error <message>".
+
+Jobs run in threads of the one process, at most *workers* at a time. Hits
+read from files are kept in a cache of the *cachesize* most recently used,
+so that a file extracted with several settings is only parsed once; a file
+that has changed since it was cached is read again.
+'''
+
+import SocketServer as _ss, json as _json, os as _os, os.path as _path
+import socket as _socket, threading as _threading, contextlib as _cont
+import signal as _signal, stat as _stat
+import classify, customcsv, extract, fasta, utils
+
+class Error(Exception):
+    """Special exception class thrown by functions in this module."""
+
+_failures = (Error,classify.Error,customcsv.Error,fasta.Error,
+             EnvironmentError,ValueError,TypeError)
+
+# the options of extract.py that jobs may give, besides extract.defaults
+options = { 'top_k' : (int,None), 'per_scaffold' : (bool,False),
+            'packed' : (bool,False) }
+
+def jobparams(job):
+    '''Returns the extraction parameters of *job* (a dict), converted and
+    with defaults filled in as extract.py does. Raises Error for keys
+    other than 'file', those of extract.defaults and those of options.'''
+    params,known = {},dict(extract.defaults,**options)
+    unknown = sorted(k for k in job if k != 'file' and k not in known)
+    if unknown: raise Error('unsupported options: %s'%', '.join(unknown))
+    for k,(T,v) in known.iteritems():
+        given = job.get(k)
+        try: params[k] = v if given is None else T(given)
+        except (TypeError,ValueError):
+            raise Error('bad type for {} (got {!r})'.format(k,given))
+    for k in ('max_overlap','min_distance','min_length'):
+        if params[k] == 0: raise Error('0 not a valid value for %s'%k)
+    if params['top_k'] is not None and params['top_k'] < 1:
+        raise Error('top_k must be at least 1')
+    return params
+
+def run_job(job,rfile,wfile,cache=None):
+    '''Runs the extraction described by *job*, reading hits from the file
+    it names or else from *rfile*, and writes the fasta output to *wfile*.
+    Hits read from files are kept in *cache*, a utils.lrucache.'''
+    params = jobparams(job)
+    if job.get('file') is None:
+        hits = classify.hitsfromcsv(_stream(rfile),packed=params['packed'],
+                                    evalue=params['evalue_threshold'])
+    else: hits = _cachedhits(job['file'],params['evalue_threshold'],
+                             params['packed'],cache)
+    classify.full_transposon_treatment(
+         seq = hits,
+         overlap = params['max_overlap'],
+         gap = params['min_distance'],
+         minlength = params['min_length'],
+         evalue = params['evalue_threshold'],
+         topk = params['top_k'],
+         perscaffold = params['per_scaffold'],
+         fastaout = fasta.fasta(wfile,'f'))
+
+def _cachedhits(fname,evalue,packed,cache):
+    st = _os.stat(fname)
+    key = (_path.realpath(fname),st.st_size,st.st_mtime,evalue,packed)
+    hits = None if cache is None else cache.get(key)
+    if hits is None:
+        hits = list(classify.hitsfromcsv(fname,evalue=evalue,lazyseq=True,
+                                         fields=classify.allflds,
+                                         packed=packed))
+        if cache is not None: cache[key] = hits
+    # the extraction renames and annotates its hits, so it gets copies
+    return [h.copy() for h in hits]
+
+class _stream(object):
+    '''The rest of a connection, as a file that customcsv can read.'''
+    name = '<connection>'
+    def __init__(self,f): self._f = f
+    def __iter__(self): return self
+    def next(self): return self._f.next()
+    def read(self,*args): return self._f.read(*args)
+    def __enter__(self): return self
+    def __exit__(self,type,value,traceback): pass
+
+class _Handler(_ss.StreamRequestHandler):
+    wbufsize = 1<<16
+    def handle(self):
+        try:
+            job = _json.loads(self.rfile.readline())
+            if not isinstance(job,dict): raise Error('job must be an object')
+            with self.server.slots:
+                run_job(job,self.rfile,self.wfile,self.server.cache)
+        except _failures as e:
+            self.wfile.write('#error {}\n'.format(str(e).replace('\n',' ')))
+        else: self.wfile.write('#ok\n')
+
+class _Server(_ss.ThreadingMixIn):
+    daemon_threads = True
+    def setup_service(self,workers,cachesize):
+        self.slots = _threading.BoundedSemaphore(workers)
+        self.cache = utils.lrucache(cachesize) if cachesize else None
+class _UnixServer(_Server,_ss.UnixStreamServer): pass
+class _TCPServer(_Server,_ss.TCPServer): allow_reuse_address = True
+
+def make_server(address,workers=4,cachesize=8):
+    '''Returns a server for the service, listening at *address*: a path
+    for a Unix socket, or a port number on localhost. A socket left at
+    the path (e.g. by a service that was killed) is replaced; anything
+    else there is an Error.'''
+    if isinstance(address,basestring):
+        try: mode = _os.lstat(address).st_mode
+        except OSError: pass
+        else:
+            if not _stat.S_ISSOCK(mode):
+                raise Error('%s exists and is not a socket'%address)
+            _os.remove(address) # a stale socket
+        server = _UnixServer(address,_Handler)
+    else: server = _TCPServer(('127.0.0.1',address),_Handler)
+    server.setup_service(workers,cachesize)
+    return server
+
+def serve(address,workers=4,cachesize=8):
+    '''Runs the service at *address* (see make_server()) until interrupted,
+    or terminated with SIGTERM (which raises SystemExit); either way, the
+    socket is closed and its path removed.'''
+    def terminate(signum,frame): raise SystemExit(128+signum)
+    server = make_server(address,workers,cachesize)
+    try:
+        oldterm = _signal.signal(_signal.SIGTERM,terminate)
+    except ValueError: oldterm = None # not the main thread
+    try: server.serve_forever()
+    finally:
+        if oldterm is not None: _signal.signal(_signal.SIGTERM,oldterm)
+        server.server_close()
+        if isinstance(address,basestring) and _path.exists(address):
+            _os.remove(address)
+
+def submit(address,job,out,hits=None):
+    '''Sends *job* (a dict; see the module documentation) to the service at
+    *address*, and writes the fasta it sends back to *out*. If the job
+    names no file, the hits are sent from *hits*, a file object or name.
+    Raises Error if the service reports one.'''
+    sock = _socket.socket(*((_socket.AF_UNIX,) if isinstance(address,
+        basestring) else (_socket.AF_INET,)))
+    sock.connect(address if isinstance(address,basestring)
+                 else ('127.0.0.1',address))
+    try:
+        sock.sendall(_json.dumps(job)+'\n')
+        if job.get('file') is None:
+            with utils.quickopen('-' if hits is None else hits,'r') as f:
+                for line in f: sock.sendall(line)
+        sock.shutdown(_socket.SHUT_WR)
+        with _cont.closing(sock.makefile('r')) as f:
+            for line in f:
+                if line.startswith('#ok'): return
+                if line.startswith('#error'): raise Error(line[7:].rstrip())
+                out.write(line)
+        raise Error('connection closed before the job was done')
+    finally: sock.close()
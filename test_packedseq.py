@@ -0,0 +1,55 @@
+'''test_packedseq.py
+
+Tests of packedseq, run as 'python -m unittest test_packedseq'.
+'''
+
+import cPickle as _pickle, random as _random, string as _string
+import unittest as _unittest
+import classify, packedseq
+
+def randseq(rnd,n):
+    '''A random gapped sequence, with runs of N and of lower case.'''
+    s = ''.join(rnd.choice('ACGTACGTACGT--N') for _ in xrange(n))
+    if s and rnd.random() < .5:
+        i = rnd.randrange(len(s)) ; j = rnd.randrange(i,len(s)+1)
+        s = s[:i] + s[i:j].lower() + s[j:]
+    return s
+
+class packedseq_test(_unittest.TestCase):
+    def test_text(self):
+        '''str(), slicing, reverse_complement() and pickling give what they
+        would for the text.'''
+        rnd = _random.Random(5)
+        rc = lambda s: s.translate(_string.maketrans(
+                'ACGTNacgtn','TGCANtgcan'))[::-1]
+        for trial in xrange(300):
+            s = randseq(rnd,rnd.randrange(40))
+            i = rnd.randrange(len(s)+1) ; j = rnd.randrange(i,len(s)+1)
+            for p,t in ((packedseq.packedseq(s),s),
+                        (packedseq.packedseq(s)[i:j],s[i:j])):
+                self.assertEqual(str(p),t)
+                self.assertEqual(len(p),len(t))
+                self.assertEqual(str(p.reverse_complement()),rc(t))
+                self.assertEqual(str(_pickle.loads(_pickle.dumps(p,2))),t)
+    def test_strip_bases(self):
+        '''lstrip_bases() and rstrip_bases() trim what classify's
+        shortenhead() and shortentail() trim from the text, and refuse
+        what they refuse.'''
+        rnd = _random.Random(6)
+        for trial in xrange(500):
+            s = randseq(rnd,rnd.randrange(30))
+            i = rnd.randrange(len(s)+1) ; j = rnd.randrange(i,len(s)+1)
+            p,t = packedseq.packedseq(s)[i:j],s[i:j]
+            bases = len(t) - t.count('-')
+            for n in xrange(bases+2):
+                for strip,shorten in ((p.lstrip_bases,classify.shortenhead),
+                                      (p.rstrip_bases,classify.shortentail)):
+                    if n > bases:
+                        self.assertRaises(ValueError,strip,n)
+                        self.assertRaises(classify.Error,shorten,t,n)
+                        self.assertRaises(classify.Error,shorten,p,n)
+                    else:
+                        self.assertEqual(str(strip(n)),shorten(t,n))
+                        self.assertEqual(str(shorten(p,n)),shorten(t,n))
+
+if __name__ == '__main__': _unittest.main()
@@ -0,0 +1,113 @@
+'''test_utils.py
+
+Tests of utils, run as 'python -m unittest test_utils'.
+'''
+
+import os as _os, random as _random, resource as _resource, tempfile as _tmp
+import unittest as _unittest
+import customcsv, utils
+
+class external_sort_test(_unittest.TestCase):
+    def setUp(self):
+        fd,self.name = _tmp.mkstemp(suffix='.csv')
+        rnd = _random.Random(1)
+        with _os.fdopen(fd,'w') as f:
+            f.write('KEY,SEQ\n')
+            for n in xrange(3000):
+                f.write('%d,%s\n'%(rnd.randrange(100),
+                        ''.join(rnd.choice('ACGT') for _ in xrange(20))))
+    def tearDown(self): _os.remove(self.name)
+    def records(self):
+        return customcsv.parseHeaderedCSV(self.name,intflds=['KEY'],
+                                          lazyflds=['SEQ'])
+    def test_more_runs_than_fds(self):
+        '''Spilling more runs than the process may open files, of items
+        holding lazyfields, neither runs out of files nor unsorts them.'''
+        key = lambda r: r.KEY
+        expected = [(r.KEY,str(r.SEQ)) for r in sorted(self.records(),key=key)]
+        soft,hard = _resource.getrlimit(_resource.RLIMIT_NOFILE)
+        _resource.setrlimit(_resource.RLIMIT_NOFILE,(64,hard))
+        try:
+            got = [(r.KEY,str(r.SEQ)) for r in utils.external_sort(
+                   self.records(),key=key,maxmem=1,sizeof=lambda r: 1)]
+        finally: _resource.setrlimit(_resource.RLIMIT_NOFILE,(soft,hard))
+        self.assertEqual(got,expected)
+
+class components_test(_unittest.TestCase):
+    def test_by_interval_matches_components(self):
+        '''components_by_interval() gives the components, and the order of
+        the items within them, that the pairwise search does.'''
+        rnd = _random.Random(2)
+        st,en = lambda x: x[0],lambda x: x[1]
+        for trial in xrange(300):
+            n,width = rnd.randrange(1,40),rnd.choice((10,50,200))
+            items = []
+            for k in xrange(n):
+                s = rnd.randrange(width)
+                items.append((s,s+rnd.randrange(-2,15),k))
+            for slack in (-5,-1,0,1,3,20):
+                rel = lambda x,y: max(st(x),st(y))-min(en(x),en(y)) <= slack
+                self.assertEqual(
+                    list(utils.components_by_interval(items,st,en,slack)),
+                    list(utils._components(items,rel)))
+    def test_disjoint_set(self):
+        '''disjoint_set classes are those of the pairs joined, in order of
+        first insertion.'''
+        rnd = _random.Random(3)
+        for trial in xrange(100):
+            n = rnd.randrange(1,30)
+            pairs = [(rnd.randrange(n),rnd.randrange(n))
+                     for k in xrange(rnd.randrange(n))]
+            ds = utils.disjoint_set(xrange(n))
+            for x,y in pairs: ds.union(x,y)
+            rel = lambda x,y: x == y or (x,y) in pairs or (y,x) in pairs
+            self.assertEqual(ds.classes(),sorted(
+                sorted(L) for L in utils._components(xrange(n),rel)))
+
+class indexheap_test(_unittest.TestCase):
+    def check(self,reverse):
+        '''Runs random operations on an indexheap and on the list of pairs
+        it stands for, with many ties in rank, and compares what pop()
+        gives with popmin() (or popmax()) on the list.'''
+        rnd,popfirst = _random.Random(4),(utils.popmax if reverse
+                                          else utils.popmin)
+        rank = lambda p: p[1]
+        for trial in xrange(200):
+            pairs = [(k,rnd.randrange(5)) for k in xrange(rnd.randrange(20))]
+            heap,serial = utils.indexheap(pairs,reverse=reverse),len(pairs)
+            handles = range(len(pairs))
+            for op in xrange(60):
+                choice = rnd.randrange(6) if pairs else 0
+                if choice == 0:
+                    pairs.append((serial,rnd.randrange(5)))
+                    handles.append(heap.push(*pairs[-1])) ; serial += 1
+                    continue
+                i = rnd.randrange(len(pairs))
+                if choice == 1:
+                    items = [x for x,r in pairs]
+                    expected = popfirst(pairs,key=rank)
+                    handles.pop(items.index(expected[0]))
+                    self.assertEqual(heap.pop(),expected)
+                elif choice == 2:
+                    self.assertEqual(heap.remove(handles.pop(i)),pairs.pop(i))
+                elif choice == 3:
+                    pairs[i] = pairs[i][0],rnd.randrange(5)
+                    heap.update(handles[i],pairs[i][1])
+                elif choice == 4:
+                    pairs[i] = serial,pairs[i][1] ; serial += 1
+                    heap.replace(handles[i],pairs[i][0])
+                else:
+                    new = [(serial+k,rnd.randrange(5))
+                           for k in xrange(rnd.randrange(4))]
+                    serial += len(new)
+                    handles[i:i+1] = heap.splice(handles[i],new)
+                    pairs[i:i+1] = new
+                self.assertEqual(len(heap),len(pairs))
+                self.assertEqual(sorted(heap.handles()),sorted(handles))
+                self.assertEqual([heap[h] for h in handles],
+                                 [x for x,r in pairs])
+            while pairs: self.assertEqual(heap.pop(),popfirst(pairs,key=rank))
+    def test_min(self): self.check(False)
+    def test_max(self): self.check(True)
+
+if __name__ == '__main__': _unittest.main()
@@ -5,6 +5,8 @@ that they belong in a shared module.
 '''
 
 import os as _os, collections as _coll, sys as _sys, functools as _func, signal
+import bisect as _bisect, operator as _op, heapq as _heapq, tempfile as _tmp
+import cPickle as _pickle, threading as _threading
 
 def quickopen(f_obj='-',mode='r',bufsize=-1):
     '''Flexibly returns a file object. Can take:
@@ -41,18 +43,26 @@ def bifilter(seq,key=None):
     d = groupby(seq,key=_key)
     return d.get(True,[]),d.get(False,[])
 
-def equiv_classes(seq,rel):
+def equiv_classes(seq,rel=None,key=None):
     '''Partitions seq according to the equivalence relation rel. Expects the
     following: if rel(x,y) then rel(y,x), and if furthermore rel(y,z), then
     rel(x,z) (i.e. rel is symmetric and transitive).
+
+    If the relation is "key(x)==key(y)" for some function returning hashable
+    values, give *key* instead of *rel*: the classes are then found in a
+    single pass rather than by comparing each item against every class.
     '''
+    if key is not None:
+        d = _coll.OrderedDict()
+        for x in seq: d.setdefault(key(x),[]).append(x)
+        return d.values()
     parts = []
     for x in seq:
         try: next(L for L in parts if rel(L[0],x)).append(x)
         except StopIteration: parts.append([x])
     return parts 
 
-def components(iterable,rel):
+def components(iterable,rel=None,interval=None):
     '''Performs a breadth-first search of *iterable*, using the graph
     structure implied by *rel*, and returns an iterator over the
     connected components.
@@ -67,7 +77,15 @@ def components(iterable,rel):
     Expects rel to be reflexive -- rel(x,x) is never false -- and symmetric
     -- if rel(x,y) then rel(y,x). If rel happens to be transitive as well,
     this may be slower than necessary: see equiv_classes().
+
+    If the relation compares intervals, give *interval* = (start,end,slack)
+    instead of *rel*; see components_by_interval(), which gives the same
+    result in O(n log n) time rather than O(n**2).
     '''
+    if interval is not None: return components_by_interval(iterable,*interval)
+    return _components(iterable,rel)
+
+def _components(iterable,rel):
     seq,parts = list(iterable),[]
     while seq:
         part,toadd = [],[seq.pop(0)]
@@ -76,8 +94,103 @@ def components(iterable,rel):
             toadd,seq = bifilter(seq,key=lambda x: any(rel(x,y) for y in part))
         yield part
 
+def components_by_interval(iterable,start,end,slack=0):
+    '''Equivalent to components(iterable,rel), where rel(x,y) is true when
+
+        max(start(x),start(y)) - min(end(x),end(y)) <= slack
+
+    i.e. when the intervals [start(x),end(x)] and [start(y),end(y)] are at
+    most *slack* apart -- or, for negative *slack*, overlap by at least
+    1-slack. The components, and the order of the items within them, are
+    the same as components() would give; but the neighbors of each item
+    are found with a search tree over the intervals sorted by start.
+    '''
+    seq = list(iterable)
+    st,en = map(start,seq),map(end,seq)
+    order = sorted(xrange(len(seq)),key=st.__getitem__)
+    starts = [st[i] for i in order]
+    # an interval shorter than the required overlap has no neighbors at all
+    linked = [en[i]-st[i] >= -slack for i in xrange(len(seq))]
+    tree = _maxtree([en[i] if linked[i] else None for i in order])
+    pos = [None]*len(seq)
+    for p,i in enumerate(order): pos[i] = p
+    done = [False]*len(seq)
+    for first in xrange(len(seq)):
+        if done[first]: continue
+        part,frontier = [],[first]
+        done[first] = True ; tree.remove(pos[first])
+        while frontier:
+            part.extend(frontier)
+            found = []
+            for i in frontier:
+                if not linked[i]: continue
+                hi = _bisect.bisect_right(starts,en[i]+slack)
+                found.extend(order[p] for p in tree.popall(hi,st[i]-slack))
+            for i in found: done[i] = True
+            frontier = sorted(found)
+        yield [seq[i] for i in part]
+
+class _maxtree(object):
+    '''Segment tree over a list of numbers (or None, for an absent
+    value), which finds and removes all values at least a threshold
+    within a prefix of the list. Used by components_by_interval().'''
+    def __init__(self,vals):
+        self._n = n = 1
+        while n < len(vals): n *= 2
+        self._n,t = n,[None]*(2*n)
+        t[n:n+len(vals)] = vals
+        for i in xrange(n-1,0,-1): t[i] = max(t[2*i],t[2*i+1])
+        self._t = t
+    def remove(self,p):
+        t,i = self._t,p+self._n
+        t[i] = None ; i //= 2
+        while i: t[i] = max(t[2*i],t[2*i+1]) ; i //= 2
+    def popall(self,hi,threshold):
+        '''Removes, and returns the positions of, all values at positions
+        before *hi* which are at least *threshold*.'''
+        t,found,stack = self._t,[],[(1,0,self._n)]
+        while stack:
+            i,lo,up = stack.pop()
+            if lo >= hi or t[i] is None or t[i] < threshold: continue
+            if i >= self._n: found.append(lo) ; continue
+            mid = (lo+up)//2
+            stack.append((2*i+1,mid,up)) ; stack.append((2*i,lo,mid))
+        for p in found: self.remove(p)
+        return found
+
+class disjoint_set(object):
+    '''Union-find structure over hashable items, with path compression
+    and union by size. Items are added implicitly by find() and union().'''
+    def __init__(self,items=()):
+        self._parent,self._size = _coll.OrderedDict(),{}
+        for x in items: self.find(x)
+    def find(self,x):
+        '''Returns the representative of the class containing x.'''
+        parent = self._parent
+        if x not in parent: parent[x],self._size[x] = x,1 ; return x
+        root = x
+        while parent[root] != root: root = parent[root]
+        while parent[x] != root: parent[x],x = root,parent[x]
+        return root
+    def union(self,x,y):
+        '''Merges the classes containing x and y, and returns the
+        representative of the merged class.'''
+        x,y = self.find(x),self.find(y)
+        if x == y: return x
+        if self._size[x] < self._size[y]: x,y = y,x
+        self._parent[y] = x ; self._size[x] += self._size.pop(y)
+        return x
+    def connected(self,x,y): return self.find(x) == self.find(y)
+    def __contains__(self,x): return x in self._parent
+    def __len__(self): return len(self._parent)
+    def classes(self):
+        '''Returns the classes as lists, in order of first insertion.'''
+        return equiv_classes(self._parent,key=self.find)
+
 def popmax(seq,key=None):
-    '''Removes the largest element of the given list, and returns it.'''
+    '''Removes the largest element of the given list, and returns it. Of
+    several largest elements, the first is taken. To do this repeatedly,
+    an indexheap is much faster.'''
     if not seq: raise ValueError('cannot pop from an empty sequence')
     if key is None: key = lambda x: x
     vi,vk = _func.reduce(lambda v,u: (u if u[1]>v[1] else v),
@@ -85,11 +198,179 @@ def popmax(seq,key=None):
     return seq.pop(vi)
 
 def popmin(seq,key=None):
-    '''Removes the largest element of the given list, and returns it.'''
+    '''Removes the smallest element of the given list, and returns it. Of
+    several smallest elements, the first is taken. To do this repeatedly,
+    an indexheap is much faster.'''
     if not seq: raise ValueError('cannot pop from an empty sequence')
     if key is None: key = lambda x: x
     vi,vk = _func.reduce(lambda v,u: (u if u[1]<v[1] else v),
                    enumerate(map(key,seq)))
     return seq.pop(vi)
 
+class indexheap(object):
+    '''Binary heap of (item,rank) pairs, with the smallest rank on top --
+    or the largest, if *reverse* is true. push() returns a handle, through
+    which an entry can later be read, removed, replaced or re-ranked.
+
+    Entries keep their place in a list order, as if they had been appended
+    to a list of (item,rank) pairs, and ties in rank are broken by that
+    order, the first entry winning. So pop() on a heap built from a list L
+    gives the same pair as popmin(L,key=itemgetter(1)) (or popmax() if
+    *reverse*), and splice(h,pairs) plays the part of L[i:i+1] = pairs.
+    '''
+    def __init__(self,pairs=(),reverse=False):
+        self._heap,self._pos,self._reverse,self._count = [],{},reverse,0
+        for item,rank in pairs: self.push(item,rank)
+    def _before(self,a,b):
+        if a[0] != b[0]: return (a[0] > b[0]) if self._reverse else a[0] < b[0]
+        return a[1] < b[1]
+    def _place(self,i,entry):
+        self._heap[i] = entry ; self._pos[entry[2]] = i
+    def _siftup(self,i):
+        heap,entry = self._heap,self._heap[i]
+        while i:
+            parent = (i-1)//2
+            if not self._before(entry,heap[parent]): break
+            self._place(i,heap[parent]) ; i = parent
+        self._place(i,entry)
+    def _siftdown(self,i):
+        heap,entry,n = self._heap,self._heap[i],len(self._heap)
+        while 2*i+1 < n:
+            child = 2*i+1
+            if child+1 < n and self._before(heap[child+1],heap[child]):
+                child += 1
+            if not self._before(heap[child],entry): break
+            self._place(i,heap[child]) ; i = child
+        self._place(i,entry)
+    def _push(self,item,rank,order):
+        handle,self._count = self._count,self._count+1
+        self._heap.append([rank,order,handle,item])
+        self._siftup(len(self._heap)-1)
+        return handle
+    def push(self,item,rank):
+        '''Adds (item,rank) after all present entries; returns a handle.'''
+        return self._push(item,rank,(self._count,))
+    def peek(self):
+        '''Returns the top (item,rank) pair, without removing it.'''
+        if not self._heap: raise IndexError('peek at an empty heap')
+        return self._heap[0][3],self._heap[0][0]
+    def pop(self):
+        '''Removes and returns the top (item,rank) pair.'''
+        if not self._heap: raise IndexError('pop from an empty heap')
+        return self.remove(self._heap[0][2])
+    def remove(self,handle):
+        '''Removes the entry with the given handle; returns (item,rank).'''
+        i = self._pos.pop(handle)
+        entry,last = self._heap[i],self._heap.pop()
+        if i < len(self._heap):
+            self._place(i,last) ; self._siftup(i)
+            self._siftdown(self._pos[last[2]])
+        return entry[3],entry[0]
+    def update(self,handle,rank):
+        '''Gives the entry with the given handle a new rank, higher or
+        lower than before.'''
+        i = self._pos[handle]
+        self._heap[i][0] = rank
+        self._siftup(i) ; self._siftdown(self._pos[handle])
+    def replace(self,handle,item,rank=None):
+        '''Swaps in a new item (and, if given, rank) for the entry with
+        the given handle. The entry keeps its handle and its place in the
+        list order.'''
+        self._heap[self._pos[handle]][3] = item
+        if rank is not None: self.update(handle,rank)
+    def splice(self,handle,pairs):
+        '''Replaces the entry with the given handle by the given (item,rank)
+        pairs, which take its place in the list order; returns their handles.
+        '''
+        order = self._heap[self._pos[handle]][1]
+        self.remove(handle)
+        return [self._push(item,rank,order+(k,))
+                for k,(item,rank) in enumerate(pairs)]
+    def __getitem__(self,handle): return self._heap[self._pos[handle]][3]
+    def __contains__(self,handle): return handle in self._pos
+    def __len__(self): return len(self._heap)
+    def handles(self):
+        '''Returns the handles of all entries, in no particular order
+        (that of the heap, which costs nothing to give).'''
+        return [e[2] for e in self._heap]
+
+def external_sort(iterable,key=None,maxmem=None,sizeof=None,tmpdir=None):
+    '''Returns an iterator over the items of *iterable*, sorted (stably)
+    by *key*. Items are gathered until their total size, as measured by
+    *sizeof* (default sys.getsizeof), reaches *maxmem* bytes; each such run
+    is sorted and pickled to a temporary file in *tmpdir*, and the runs are
+    merged at the end, so that only one item per run is held in memory. If
+    everything fits (or *maxmem* is None), it is sorted in memory.
+
+    Every _FANIN runs of a size are merged into one as they come, so that
+    only a few dozen files are open however many runs there are.'''
+    if key is None: key = lambda x: x
+    if sizeof is None: sizeof = _sys.getsizeof
+    runs,run,size = [],[],0 # runs holds (level,file) pairs
+    try:
+        for n,x in enumerate(iterable):
+            run.append((key(x),n,x))
+            size += sizeof(x)
+            if maxmem is not None and size >= maxmem:
+                _addrun(runs,_spill(run,tmpdir),tmpdir) ; run,size = [],0
+        run.sort(key=_op.itemgetter(0,1))
+        if not runs:
+            for k,n,x in run: yield x
+            return
+        if run: _addrun(runs,_spill(run,tmpdir),tmpdir) ; del run[:]
+        for k,n,x in _heapq.merge(*[_unspill(f) for l,f in runs]): yield x
+    finally:
+        for l,f in runs: f.close()
+
+_FANIN = 16 # the number of runs merged at once by external_sort
+def _addrun(runs,f,tmpdir):
+    runs.append((0,f))
+    while len(runs) >= _FANIN and runs[-_FANIN][0] == runs[-1][0]:
+        level,merging = runs[-1][0],[f for l,f in runs[-_FANIN:]]
+        del runs[-_FANIN:]
+        try: f = _write(_heapq.merge(*map(_unspill,merging)),tmpdir)
+        finally:
+            for m in merging: m.close()
+        runs.append((level+1,f))
+def _spill(run,tmpdir):
+    run.sort(key=_op.itemgetter(0,1))
+    return _write(run,tmpdir)
+def _write(items,tmpdir):
+    f = _tmp.TemporaryFile(dir=tmpdir)
+    pk = _pickle.Pickler(f,_pickle.HIGHEST_PROTOCOL)
+    for x in items: pk.dump(x) ; pk.clear_memo()
+    f.seek(0) ; return f
+def _unspill(f):
+    up = _pickle.Unpickler(f)
+    while True:
+        try: yield up.load()
+        except EOFError: return
+
+def parsesize(s):
+    '''Converts a size such as '512M' or '4G' (or a plain number of
+    bytes) to a number of bytes.'''
+    s = str(s).strip().upper().rstrip('B')
+    mult = 1024**('KMGT'.index(s[-1])+1) if s and s[-1] in 'KMGT' else 1
+    try: return int(float(s[:-1] if mult > 1 else s) * mult)
+    except ValueError: raise ValueError('bad size: %r'%s)
+
+class lrucache(object):
+    '''A mapping that holds at most *maxsize* entries, forgetting the least
+    recently used (set or got) when it is full. Safe to share between
+    threads.'''
+    def __init__(self,maxsize):
+        self.maxsize,self._d,self._lock = maxsize,_coll.OrderedDict(),\
+                                          _threading.Lock()
+    def get(self,key,default=None):
+        with self._lock:
+            try: value = self._d.pop(key)
+            except KeyError: return default
+            self._d[key] = value ; return value
+    def __setitem__(self,key,value):
+        with self._lock:
+            self._d.pop(key,None) ; self._d[key] = value
+            while len(self._d) > self.maxsize: self._d.popitem(last=False)
+    def __contains__(self,key): return key in self._d
+    def __len__(self): return len(self._d)
+
 def restoresigpipe(): signal.signal(signal.SIGPIPE, signal.SIG_DFL)